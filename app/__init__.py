@@ -1,24 +1,29 @@
 import logging
 import os
 
-from logging.handlers import SMTPHandler, RotatingFileHandler
-from logging import Formatter
+from logging.handlers import RotatingFileHandler
 
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask.logging import default_handler
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
-
+from redis import Redis
+import rq
+
+from app.live import LiveUpdates
+from app.log import JSONFormatter, RequestLogging
+from app.pool import PoolMetrics
+from app.presence import LastSeen
+from app.profiling import RequestProfiler
+from app.replicas import RoutingSQLAlchemy
+from app.telemetry import Telemetry
 from config import Config
 
 
-db = SQLAlchemy()
-migrate = Migrate()
+db = RoutingSQLAlchemy()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l("You have to logged in before you can view this resource")
@@ -26,6 +31,12 @@ mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
+request_logging = RequestLogging()
+last_seen = LastSeen()
+pool_metrics = PoolMetrics()
+telemetry = Telemetry()
+profiler = RequestProfiler()
+live_updates = LiveUpdates()
 
 
 def create_app(config_class=Config):
@@ -33,24 +44,26 @@ def create_app(config_class=Config):
 
     app.config.from_object(config_class)
 
-    if os.environ.get('ELASTICSEARCH_URL'):
-        app.elasticsearch = Elasticsearch(os.environ.get('ELASTICSEARCH_URL'))
-    elif os.environ.get('ELASTICSEARCH_CLOUD_ID'):
-        app.elasticsearch = Elasticsearch(
-            cloud_id=os.environ.get('ELASTICSEARCH_CLOUD_ID'),
-            basic_auth=(os.environ.get('ELASTICSEARCH_USER'), os.environ.get('ELASTICSEARCH_PASS'))
-        )
+    if app.config['REDIS_URL']:
+        app.redis = Redis.from_url(app.config['REDIS_URL'])
+        app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
     else:
-        app.elasticsearch = None
+        app.redis = None
+        app.task_queue = None
 
     # Register extensions
     db.init_app(app)
-    migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
+    request_logging.init_app(app)
+    last_seen.init_app(app)
+    pool_metrics.init_app(app)
+    telemetry.init_app(app)
+    profiler.init_app(app)
+    live_updates.init_app(app)
 
 
     # Register Blueprints
@@ -63,41 +76,51 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
+    if app.config['METRICS_ENABLED']:
+        from app.metrics import bp as metrics_bp
+        app.register_blueprint(metrics_bp, url_prefix='/metrics')
+
 
     if not app.debug:
+        from app.email import ErrorMailHandler
+
         """
         Configure the mail server to send any unhandled exception that occurred
         while the application is running in production environment.
         """
+        handlers = []
         if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-
-            mailhandler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            mailhandler = ErrorMailHandler(
+                app,
                 fromaddr='no-reply@' + app.config['MAIL_SERVER'],
                 toaddrs=app.config['ADMINS'],
-                subject='Microblog Failure!',
-                credentials=auth,
-                secure=secure
+                subject='Microblog Failure!'
             )
             mailhandler.setLevel(logging.ERROR)
-            app.logger.addHandler(mailhandler)
+            handlers.append(mailhandler)
 
         # set the directory for the logs
         if not os.path.exists('logs'):
             os.makedirs('logs')
 
-        filehandler = RotatingFileHandler('logs/microblog.log', maxBytes=10240, backupCount=10)
-        filehandler.setFormatter(
-            Formatter("%(asctime)s %(levelname)s: %(msg)s [in %(pathname)s:%(lineno)d]")
-        )
+        filehandler = RotatingFileHandler(
+            'logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=app.config['LOG_BACKUP_COUNT'])
+        filehandler.setFormatter(JSONFormatter())
         filehandler.setLevel(logging.INFO)
-        app.logger.addHandler(filehandler)
+        handlers.append(filehandler)
+
+        # stderr still gets the logs, for the container and process logs
+        streamhandler = logging.StreamHandler()
+        streamhandler.setFormatter(default_handler.formatter)
+        streamhandler.setLevel(logging.INFO)
+        handlers.append(streamhandler)
+
+        # the handlers write from a background thread, never from requests
+        request_logging.start(app, *handlers)
 
         app.logger.setLevel(logging.INFO)
         app.logger.info("Microblog startup")
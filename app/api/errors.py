@@ -0,0 +1,28 @@
+from flask import jsonify
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+
+from app.api import bp
+
+
+def error_response(status_code, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    response = jsonify(payload)
+    response.status_code = status_code
+    return response
+
+
+def bad_request(message):
+    return error_response(400, message)
+
+
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    response = error_response(error.code)
+    # keep the headers of the error, e.g. Retry-After
+    for name, value in error.get_headers():
+        if name != 'Content-Type':
+            response.headers[name] = value
+    return response
@@ -0,0 +1,98 @@
+import gzip
+
+from flask import abort, current_app, g, request
+
+from app.api import bp
+from app.main.pagination import pager_urls
+
+# most ids a batch request may ask for
+MAX_BATCH_SIZE = 100
+
+
+def requested_fields():
+    """
+    Read the comma separated `fields` to return, None for all of them
+    """
+    fields = request.args.get('fields')
+    return set(fields.split(',')) | {'id'} if fields else None
+
+
+def serialize(obj, fields=None, **kwargs):
+    data = obj.to_dict(**kwargs)
+    if fields is not None:
+        data = {key: value for key, value in data.items() if key in fields}
+    return data
+
+
+def requested_ids():
+    """
+    Read the comma separated `ids` of a batch request, aborting with 400
+    when they are malformed or too many
+    """
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > MAX_BATCH_SIZE:
+        abort(400)
+    return ids
+
+
+def fetch_batch(model, ids, *options):
+    """
+    Load the objects of the given ids in one query
+    :return: the objects found, in the order of ids
+    """
+    objects = {obj.id: obj for obj in model.query.options(*options).filter(model.id.in_(ids))}
+    return [objects[i] for i in ids if i in objects]
+
+
+def per_page():
+    return max(1, min(request.args.get('per_page', current_app.config['POST_PER_PAGE'], type=int),
+                      current_app.config['API_MAX_PER_PAGE']))
+
+
+def collection(items):
+    fields = requested_fields()
+    return {'items': [serialize(item, fields) for item in items]}
+
+
+def page_collection(page, endpoint, **values):
+    """
+    Serialize a CursorPage with the cursors and the urls of the next and
+    previous pages, which keep the paging and field parameters
+    """
+    for name in ('fields', 'per_page'):
+        if name in request.args:
+            values[name] = request.args[name]
+    next_url, prev_url = pager_urls(endpoint, page, **values)
+    data = collection(page.items)
+    data['_meta'] = {'next_cursor': page.next_cursor, 'prev_cursor': page.prev_cursor}
+    data['_links'] = {'next': next_url, 'prev': prev_url}
+    return data
+
+
+@bp.before_request
+def read_from_primary():
+    """
+    Token clients send no session cookie to keep their reads on the
+    primary after a write, so they always read from it
+    """
+    g.primary_reads = True
+
+
+@bp.after_request
+def compress(response):
+    """
+    Gzip the responses big enough to be worth it for clients accepting it
+    """
+    if response.direct_passthrough or 'Content-Encoding' in response.headers or \
+            'gzip' not in request.accept_encodings:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config['API_GZIP_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
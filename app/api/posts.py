@@ -0,0 +1,66 @@
+from flask import request, url_for
+
+from app import db, live_updates
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.api.helpers import (
+    collection, fetch_batch, page_collection, per_page, requested_fields, requested_ids,
+    serialize
+)
+from app.language import queue_language_detection
+from app.main.models import Post
+from app.main.pagination import KeysetPagination, cursor_args, decode_search_cursor
+
+# same limit as the post form
+MAX_POST_LENGTH = 150
+
+
+@bp.route('/posts/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_post(id):
+    post = Post.query.options(db.joinedload(Post.author)).filter_by(id=id).first_or_404()
+    return serialize(post, requested_fields())
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    """
+    All the posts, newest first, or a batch of posts when `ids` are given
+    """
+    if 'ids' in request.args:
+        return collection(fetch_batch(Post, requested_ids(), db.joinedload(Post.author)))
+    posts = KeysetPagination(Post.query.options(db.joinedload(Post.author)),
+                             per_page(), **cursor_args())
+    return page_collection(posts, 'api.get_posts')
+
+
+@bp.route('/posts', methods=['POST'])
+@token_auth.login_required
+def create_post():
+    data = request.get_json(silent=True) or {}
+    body = data.get('body')
+    if not isinstance(body, str) or not body.strip() or len(body) > MAX_POST_LENGTH:
+        return bad_request(f'body must be a text of 1 to {MAX_POST_LENGTH} characters')
+
+    post = Post(body=body, author=token_auth.current_user())
+    db.session.add(post)
+    db.session.flush()
+    post.fan_out()
+    db.session.commit()
+    queue_language_detection(post)
+    live_updates.publish(post)
+    return serialize(post), 201, {'Location': url_for('api.get_post', id=post.id)}
+
+
+@bp.route('/search', methods=['GET'])
+@token_auth.login_required
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('q is required')
+    posts = Post.search_page(q, per_page(),
+                             after=decode_search_cursor(request.args.get('after')),
+                             before=decode_search_cursor(request.args.get('before')))
+    return page_collection(posts, 'api.search', q=q)
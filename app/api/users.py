@@ -0,0 +1,79 @@
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.api.helpers import (
+    collection, fetch_batch, page_collection, per_page, requested_fields, requested_ids,
+    serialize
+)
+from app.main.caching import invalidate
+from app.main.models import Post, User
+from app.main.pagination import KeysetPagination, cursor_args
+
+
+@bp.route('/users/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_user(id):
+    user = User.query.get_or_404(id)
+    return serialize(user, requested_fields(),
+                     include_email=user == token_auth.current_user())
+
+
+@bp.route('/users', methods=['GET'])
+@token_auth.login_required
+def get_users():
+    """
+    Batch fetch of the users of the comma separated `ids`
+    """
+    return collection(fetch_batch(User, requested_ids()))
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    user = User.query.get_or_404(id)
+    posts = KeysetPagination(Post.query.filter_by(user_id=user.id).options(
+        db.joinedload(Post.author)), per_page(), **cursor_args())
+    return page_collection(posts, 'api.get_user_posts', id=id)
+
+
+@bp.route('/timeline', methods=['GET'])
+@token_auth.login_required
+def get_timeline():
+    posts = token_auth.current_user().timeline_page(per_page(), **cursor_args())
+    return page_collection(posts, 'api.get_timeline')
+
+
+@bp.route('/users/<int:id>/follow', methods=['POST'])
+@token_auth.login_required
+def follow(id):
+    user = User.query.get_or_404(id)
+    current_user = token_auth.current_user()
+    if user == current_user:
+        return bad_request('you cannot follow yourself')
+    if not current_user.is_following(user):
+        current_user.follow(user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request recorded the same follow first
+            db.session.rollback()
+            return '', 204
+        invalidate(f'user:{user.username}', f'user:{current_user.username}')
+    return '', 204
+
+
+@bp.route('/users/<int:id>/follow', methods=['DELETE'])
+@token_auth.login_required
+def unfollow(id):
+    user = User.query.get_or_404(id)
+    current_user = token_auth.current_user()
+    if user == current_user:
+        return bad_request('you cannot unfollow yourself')
+    if current_user.is_following(user):
+        current_user.unfollow(user)
+        db.session.commit()
+        invalidate(f'user:{user.username}', f'user:{current_user.username}')
+    return '', 204
@@ -28,6 +28,11 @@ def login():
             flash(_("Invalid Username or Password"))
             return render_template('auth/login.html', title="Sign In", form=form)
 
+        # upgrade hashes made with outdated parameters while the password is known
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+
         login_user(user, remember=form.remember_me.data)
 
         next_url = request.args.get('next')
@@ -0,0 +1,50 @@
+from functools import lru_cache
+from hashlib import md5
+
+import requests
+from flask import current_app
+
+from app.cache import LRUCache, RedisCache, TieredCache
+from app.http import http_session
+
+
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def gravatar_url(hexdigest, size):
+    return f"https://www.gravatar.com/avatar/{hexdigest}?s={size}&d=identicon"
+
+
+def _cache():
+    cache = current_app.extensions.get('avatar_cache')
+    if cache is None:
+        ttl = current_app.config['AVATAR_CACHE_TTL']
+        shared = None
+        if current_app.redis is not None:
+            shared = RedisCache(current_app.redis, 'avatar:', ttl)
+        cache = TieredCache(LRUCache(current_app.config['AVATAR_CACHE_SIZE'], ttl), shared)
+        current_app.extensions['avatar_cache'] = cache
+    return cache
+
+
+def fetch_avatar(hexdigest, size):
+    """
+    Get an avatar image from gravatar, or from the local cache
+    :return: tuple(image bytes, mimetype, etag) or None if gravatar failed
+    """
+    key = f'{hexdigest}:{size}'
+    cache = _cache()
+    image = cache.get(key)
+    if image is None:
+        try:
+            r = http_session().get(gravatar_url(hexdigest, size), timeout=5)
+        except requests.RequestException:
+            return None
+        if r.status_code != 200:
+            return None
+        image = (r.content, r.headers.get('Content-Type', 'image/png'),
+                 md5(r.content).hexdigest())
+        cache.set(key, image)
+    return image
@@ -0,0 +1,110 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+
+class LRUCache(object):
+    """
+    Thread safe in-process cache evicting the least recently used entries
+    beyond maxsize, with a time to live in seconds for every entry
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(object):
+    """
+    Cache shared by all the processes through redis, values are pickled.
+    Redis errors are treated as misses so that the cache never breaks a
+    request.
+    """
+    def __init__(self, redis, prefix, ttl=None):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            value = self.redis.get(self.prefix + key)
+        except RedisError:
+            return None
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        try:
+            self.redis.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+        except RedisError:
+            pass
+
+    def delete(self, key):
+        try:
+            self.redis.delete(self.prefix + key)
+        except RedisError:
+            pass
+
+
+class TieredCache(object):
+    """
+    An in-process cache in front of an optional shared one. Hits of the
+    shared tier are copied into the local one.
+    """
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
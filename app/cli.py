@@ -1,8 +1,18 @@
+import importlib
+import itertools
 import os
 import click
 
 
 def register(app):
+    # set up here rather than in create_app, so that alembic is only
+    # loaded by the flask command line, which runs the db commands
+    from flask_migrate import Migrate
+
+    from app import db
+
+    Migrate(app, db)
+
     @app.cli.group()
     def translate():
         """
@@ -31,3 +41,149 @@ def register(app):
         if os.system(f"pybabel init -i messages.pot -d app/translations -l {lang}"):
             raise RuntimeError("Init command failed")
         os.remove('messages.pot')
+
+    @app.cli.group()
+    def language():
+        """
+        Language detection commands
+        """
+        pass
+
+    @language.command()
+    @click.option('--batch-size', default=500, help='Posts detected per transaction')
+    def backfill(batch_size):
+        """
+        Detect the language of the posts that have none
+        """
+        from app.language import backfill_languages, preload_profiles
+
+        preload_profiles()
+        updated = backfill_languages(batch_size)
+        click.echo(f"Detected the language of {updated} posts")
+
+    @app.cli.group()
+    def counters():
+        """
+        Denormalized counter commands
+        """
+        pass
+
+    @counters.command()
+    def reconcile():
+        """
+        Recompute the follower, followed and post counters of every user
+        """
+        from app.main.models import User
+
+        User.reconcile_counters()
+        click.echo("Counters reconciled")
+
+    @app.cli.group()
+    def data():
+        """
+        Bulk export and import commands
+        """
+        pass
+
+    def report(table, rows):
+        click.echo(f"{table}: {rows} rows", err=True)
+
+    @data.command()
+    @click.argument('output', type=click.Path())
+    @click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+                  help='ndjson writes one file, csv one file per table in the OUTPUT directory')
+    @click.option('--table', 'tables', multiple=True, help='Table to export, default all')
+    @click.option('--chunk-size', default=1000, help='Rows read per query')
+    def export(output, fmt, tables, chunk_size):
+        """
+        Stream users, follows and posts to OUTPUT, - for stdout
+        """
+        from app.data import DUMP_COLUMNS, write_csv, write_ndjson
+
+        tables = tables or list(DUMP_COLUMNS)
+        for name in tables:
+            if name not in DUMP_COLUMNS:
+                raise click.BadParameter(f"unknown table {name!r}", param_hint='--table')
+
+        if fmt == 'ndjson':
+            with click.open_file(output, 'w', encoding='utf-8') as stream:
+                written = write_ndjson(stream, tables, chunk_size, report)
+        else:
+            os.makedirs(output, exist_ok=True)
+            written = 0
+            for name in tables:
+                with open(os.path.join(output, f'{name}.csv'), 'w', newline='',
+                          encoding='utf-8') as stream:
+                    written += write_csv(stream, name, chunk_size, report)
+        click.echo(f"Exported {written} rows", err=True)
+
+    @data.command(name='import')
+    @click.argument('source', type=click.Path())
+    @click.option('--chunk-size', default=5000, help='Rows inserted per statement')
+    @click.option('--no-reindex', is_flag=True, help='Leave the search index as it is')
+    def import_(source, chunk_size, no_reindex):
+        """
+        Load a dump written by export: an ndjson file, - for stdin, or a
+        directory of csv files
+        """
+        from app.data import DUMP_COLUMNS, import_rows, read_csv, read_ndjson, rebuild
+
+        if os.path.isdir(source):
+            paths = [os.path.join(source, f'{name}.csv') for name in DUMP_COLUMNS]
+            streams = [open(path, newline='', encoding='utf-8')
+                       for path in paths if os.path.exists(path)]
+            records = itertools.chain.from_iterable(
+                read_csv(stream, os.path.splitext(os.path.basename(stream.name))[0])
+                for stream in streams)
+        else:
+            streams = [click.open_file(source, encoding='utf-8')]
+            records = read_ndjson(streams[0])
+
+        try:
+            counts = import_rows(records, chunk_size, report)
+        finally:
+            for stream in streams:
+                stream.close()
+        click.echo("Imported " + ", ".join(
+            f"{rows} {table} rows" for table, rows in counts.items()), err=True)
+
+        click.echo("Rebuilding counters, timelines" +
+                   ("" if no_reindex else " and the search index"), err=True)
+        rebuild(reindex=not no_reindex)
+
+    @app.cli.command('startup-profile')
+    @click.option('--limit', default=15, help='Number of imports listed')
+    def startup_profile(limit):
+        """
+        Report the import and init times of a cold start of the application
+        """
+        from app.startup import app_imports, profile_startup
+
+        report = profile_startup()
+        imports = app_imports(report['imports'])
+        click.echo("Imports")
+        for name, seconds in sorted(imports, key=lambda item: -item[1])[:limit]:
+            click.echo(f"  {seconds * 1000:8.1f} ms  {name}")
+        for title in ('extensions', 'blueprints'):
+            click.echo(title.capitalize())
+            for name, seconds in report[title]:
+                click.echo(f"  {seconds * 1000:8.1f} ms  {name}")
+        click.echo(f"import app {report['import_app'] * 1000:.1f} ms, "
+                   f"create_app {report['create_app'] * 1000:.1f} ms, "
+                   f"process {report['process'] * 1000:.1f} ms")
+        if report['lazy_modules_loaded']:
+            click.echo("Loaded at startup: " + ", ".join(report['lazy_modules_loaded']))
+
+    @app.cli.command()
+    @click.option('--burst', is_flag=True, help='Exit once the queue is empty')
+    def worker(burst):
+        """
+        Run a task queue worker with the heavy dependencies preloaded, so
+        that every forked job starts with them loaded
+        """
+        from rq import Worker
+
+        if app.task_queue is None:
+            raise click.ClickException("REDIS_URL is not configured")
+        importlib.import_module('app.tasks')
+        Worker([app.task_queue]).work(burst=burst, with_scheduler=True)
@@ -0,0 +1,192 @@
+import csv
+import json
+from datetime import datetime
+
+from app import db
+
+# the tables a dump holds, in an order that satisfies their foreign keys.
+# Counters and timelines are derived data and are rebuilt after an import
+# instead of being dumped.
+DUMP_COLUMNS = {
+    'user': ['id', 'username', 'email', 'email_hash', 'about_me', 'last_seen',
+             'password_hash'],
+    'followers': ['follower_id', 'followed_id'],
+    'post': ['id', 'body', 'timestamp', 'user_id', 'language'],
+}
+
+
+def _table(name):
+    return db.metadata.tables[name]
+
+
+def _seek(key_columns, last):
+    """
+    Condition selecting the rows after `last` in primary key order
+    """
+    first, rest = key_columns[0], key_columns[1:]
+    if not rest:
+        return first > last[0]
+    return db.or_(first > last[0], db.and_(first == last[0], _seek(rest, last[1:])))
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export_rows(name, chunk_size=1000):
+    """
+    Stream the rows of a dumped table, reading it in primary key order one
+    chunk at a time so that memory stays constant whatever the table size
+    :return: generator of dict
+    """
+    table = _table(name)
+    columns = [table.c[column] for column in DUMP_COLUMNS[name]]
+    key_columns = list(table.primary_key.columns)
+    query = db.select(*columns).order_by(*key_columns).limit(chunk_size)
+    last = None
+    while True:
+        chunk = db.session.execute(
+            query if last is None else query.where(_seek(key_columns, last))).all()
+        for row in chunk:
+            yield {key: _encode(value) for key, value in row._mapping.items()}
+        if len(chunk) < chunk_size:
+            return
+        last = [chunk[-1]._mapping[column.name] for column in key_columns]
+
+
+def write_ndjson(stream, tables=DUMP_COLUMNS, chunk_size=1000, progress=None):
+    """
+    Write the tables to a text stream as one json object per line, each
+    holding the table name and the row
+    :return: the number of rows written
+    """
+    total = 0
+    for name in tables:
+        written = 0
+        for written, row in enumerate(export_rows(name, chunk_size), 1):
+            stream.write(json.dumps({'table': name, 'row': row}) + '\n')
+            if progress and written % chunk_size == 0:
+                progress(name, written)
+        total += written
+    return total
+
+
+def write_csv(stream, name, chunk_size=1000, progress=None):
+    """
+    Write one table to a text stream as csv with a header line
+    :return: the number of rows written
+    """
+    writer = csv.DictWriter(stream, DUMP_COLUMNS[name])
+    writer.writeheader()
+    written = 0
+    for written, row in enumerate(export_rows(name, chunk_size), 1):
+        writer.writerow(row)
+        if progress and written % chunk_size == 0:
+            progress(name, written)
+    return written
+
+
+def read_ndjson(stream):
+    """
+    :return: generator of tuple(table name, row)
+    """
+    for line in stream:
+        if line.strip():
+            record = json.loads(line)
+            yield record['table'], record['row']
+
+
+def read_csv(stream, name):
+    """
+    Read a table written by write_csv. Empty fields are read as NULL.
+    :return: generator of tuple(table name, row)
+    """
+    for row in csv.DictReader(stream):
+        yield name, {key: value if value != '' else None for key, value in row.items()}
+
+
+def _decoder(name):
+    """
+    Build a function converting the json or csv values of a row of the
+    table to the python types of its columns
+    """
+    table = _table(name)
+    converters = {}
+    for column in table.c:
+        if isinstance(column.type, db.DateTime):
+            converters[column.name] = datetime.fromisoformat
+        elif isinstance(column.type, db.Integer):
+            converters[column.name] = int
+
+    def decode(row):
+        return {key: converters[key](value) if value is not None and key in converters
+                else value for key, value in row.items() if key in table.c}
+    return decode
+
+
+def import_rows(records, chunk_size=1000, progress=None):
+    """
+    Insert (table name, row) records with one executemany per chunk of
+    consecutive rows of the same table, committing after every chunk.
+
+    The inserts bypass the ORM: the counters, the timelines and the search
+    index are not maintained and must be rebuilt afterwards, see rebuild.
+    :return: dict of the number of rows inserted per table
+    """
+    counts = dict.fromkeys(DUMP_COLUMNS, 0)
+    decoders = {}
+    current, chunk = None, []
+
+    def flush():
+        if chunk:
+            db.session.execute(_table(current).insert(), chunk)
+            db.session.commit()
+            counts[current] += len(chunk)
+            if progress:
+                progress(current, counts[current])
+            chunk.clear()
+
+    for name, row in records:
+        if name not in DUMP_COLUMNS:
+            raise ValueError(f"unknown table {name!r}")
+        if name != current or len(chunk) >= chunk_size:
+            flush()
+            current = name
+        if name not in decoders:
+            decoders[name] = _decoder(name)
+        chunk.append(decoders[name](row))
+    flush()
+    return counts
+
+
+def _reset_sequences():
+    """
+    Move the id sequences of PostgreSQL past the imported ids, which the
+    inserts gave explicitly. SQLite picks the next id from the table.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for name in DUMP_COLUMNS:
+        table = _table(name)
+        if 'id' not in table.c:
+            continue
+        quoted = db.engine.dialect.identifier_preparer.quote(name)
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{quoted}', 'id'), "
+            f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {quoted}"))
+    db.session.commit()
+
+
+def rebuild(reindex=True):
+    """
+    Recompute the data derived from the imported rows: the id sequences,
+    the user counters, the home timelines and, unless disabled, the
+    search index
+    """
+    from app.main.models import Post, User
+
+    _reset_sequences()
+    User.reconcile_counters()
+    User.rebuild_timelines()
+    if reindex:
+        Post.reindex()
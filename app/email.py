@@ -1,18 +1,217 @@
-from threading import Thread
+import json
+import logging
+import smtplib
+import threading
+import time
+from concurrent import futures
+from hashlib import sha1
 
-from flask import render_template, current_app
+from flask import current_app, has_app_context
 from flask_mail import Message
+from redis.exceptions import RedisError
 
-from app import  mail
+from app import mail
+from app.pending import PendingList
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+pending_messages = PendingList('mail', 'app.tasks.send_queued_email', retry_interval=10)
+# messages the mail server rejected, kept for inspection
+FAILED_KEY = 'mail:failed'
+
+_connection_lock = threading.Lock()
 
 
 def send_email(subject, sender, recipients, html_body, text_body):
-    msg = Message(subject=subject, recipients=recipients, sender=sender)
-    msg.html = html_body
-    msg.body = text_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    queue_email([{'subject': subject, 'sender': sender, 'recipients': recipients,
+                  'html': html_body, 'body': text_body}])
+
+
+def _deliver_in_background(app, messages):
+    with app.app_context():
+        try:
+            deliver(messages)
+        except Exception:
+            app.logger.exception('Sending %d emails failed', len(messages))
+
+
+class _BackgroundSender(object):
+    """
+    Send the mail on a single thread when there is no task queue. At most
+    queue_size batches wait for it, the ones beyond are dropped, so that a
+    burst of mails or of error reports costs neither threads nor memory.
+    """
+    def __init__(self, queue_size):
+        self.executor = futures.ThreadPoolExecutor(1, thread_name_prefix='mail')
+        self.slots = threading.BoundedSemaphore(queue_size)
+
+    def submit(self, app, messages):
+        """
+        :return: False if the queue is full and the messages were dropped
+        """
+        if not self.slots.acquire(blocking=False):
+            return False
+        try:
+            future = self.executor.submit(_deliver_in_background, app, messages)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return True
+
+
+def _background_sender():
+    sender = current_app.extensions.get('mail_sender')
+    if sender is None:
+        sender = current_app.extensions['mail_sender'] = _BackgroundSender(
+            current_app.config['MAIL_QUEUE_SIZE'])
+    return sender
+
+
+def queue_email(messages):
+    """
+    Hand messages over to the task queue, whose worker sends them in
+    batches. Without a task queue they are sent by a background thread, so
+    that a slow mail server never holds up the request, and dropped when
+    MAIL_QUEUE_SIZE batches are already waiting for it.
+    :param messages: json serializable dicts with the subject, sender,
+        recipients, html and body of the messages
+    """
+    if not messages:
+        return
+
+    if current_app.task_queue is None:
+        if not _background_sender().submit(current_app._get_current_object(), messages):
+            current_app.logger.warning('Mail queue full, dropped %d emails', len(messages))
+        return
+
+    try:
+        pending_messages.push(messages, current_app.config['MAIL_SEND_RETRIES'])
+    except RedisError:
+        current_app.logger.exception('Queueing %d emails failed', len(messages))
+
+
+def _connection(reconnect=False):
+    """
+    The SMTP connection of the process, opened on first use and kept open
+    between batches
+    """
+    connection = current_app.extensions.get('mail_connection')
+    if connection is not None and reconnect:
+        try:
+            connection.__exit__(None, None, None)
+        except smtplib.SMTPException:
+            pass
+        connection = None
+    if connection is None:
+        connection = mail.connect().__enter__()
+        current_app.extensions['mail_connection'] = connection
+    return connection
+
+
+def _rejected(error):
+    """
+    Whether the server refused the message itself, which sending it again
+    would not change
+    """
+    return isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)) or \
+        isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def deliver(messages):
+    """
+    Send messages over the SMTP connection of the process. A connection
+    the server dropped while idle is opened again. Messages the server
+    rejects are logged and moved to the mail:failed list when redis is
+    available, instead of blocking the messages after them.
+    """
+    with _connection_lock:
+        connection = _connection()
+        for message in messages:
+            msg = Message(subject=message['subject'], recipients=message['recipients'],
+                          sender=message['sender'], html=message['html'],
+                          body=message['body'])
+            try:
+                try:
+                    connection.send(msg)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    connection = _connection(reconnect=True)
+                    connection.send(msg)
+            except smtplib.SMTPException as error:
+                if not _rejected(error):
+                    raise
+                current_app.logger.error('Email to %s rejected: %s',
+                                         ', '.join(message['recipients']), error)
+                if current_app.redis is not None:
+                    current_app.redis.rpush(FAILED_KEY, json.dumps(message))
+
+
+def flush_pending_email():
+    """
+    Drain the queued messages in batches of MAIL_BATCH_SIZE. A batch is only
+    removed from the queue once sent, so a failed flush is picked up again
+    by the retried job.
+    """
+    pending_messages.drain(deliver, current_app.config['MAIL_BATCH_SIZE'])
+
+
+class ErrorMailHandler(logging.Handler):
+    """
+    Mail error records to the admins through the mail queue.
+
+    The same error is mailed at most once every ERROR_MAIL_DEDUPE_SECONDS
+    and at most ERROR_MAIL_PER_MINUTE mails are sent, so that a flood of
+    errors never turns into a flood of mails. With redis the limits are
+    shared by all the processes.
+    """
+    def __init__(self, app, fromaddr, toaddrs, subject):
+        super(ErrorMailHandler, self).__init__()
+        self.app = app
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self._sent = {}
+        self._minute = (0, 0)
+        self._limit_lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(record):
+        exc_type = record.exc_info[0].__name__ if record.exc_info else ''
+        key = f'{record.pathname}:{record.lineno}:{exc_type}:{record.getMessage()[:200]}'
+        return sha1(key.encode('utf-8')).hexdigest()
+
+    def _allowed(self, fingerprint):
+        dedupe = self.app.config['ERROR_MAIL_DEDUPE_SECONDS']
+        per_minute = self.app.config['ERROR_MAIL_PER_MINUTE']
+        minute = int(time.time() // 60)
+        if self.app.redis is not None:
+            if not self.app.redis.set(f'mail:error:{fingerprint}', 1, nx=True, ex=dedupe):
+                return False
+            pipe = self.app.redis.pipeline()
+            pipe.incr(f'mail:error-rate:{minute}')
+            pipe.expire(f'mail:error-rate:{minute}', 60)
+            return pipe.execute()[0] <= per_minute
+
+        now = time.monotonic()
+        with self._limit_lock:
+            if now - self._sent.get(fingerprint, -dedupe) < dedupe:
+                return False
+            self._sent = {key: sent for key, sent in self._sent.items()
+                          if now - sent < dedupe}
+            self._sent[fingerprint] = now
+            count = self._minute[1] + 1 if self._minute[0] == minute else 1
+            self._minute = (minute, count)
+            return count <= per_minute
+
+    def emit(self, record):
+        try:
+            if not self._allowed(self.fingerprint(record)):
+                return
+            message = {'subject': self.subject, 'sender': self.fromaddr,
+                       'recipients': self.toaddrs, 'html': None, 'body': self.format(record)}
+            if has_app_context():
+                queue_email([message])
+            else:
+                with self.app.app_context():
+                    queue_email([message])
+        except Exception:
+            self.handleError(record)
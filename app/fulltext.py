@@ -0,0 +1,140 @@
+import re
+import sqlite3
+import threading
+
+from app.search import SearchBackend
+
+
+class LocalSearchBackend(SearchBackend):
+    """
+    Full-text search engine for deployments without an elasticsearch
+    cluster, built on SQLite FTS5 with BM25 ranking.
+
+    Every index is a FTS5 table, keyed by the document id, in a SQLite file
+    of its own (or in memory when the path is ':memory:'). Tables are created
+    on the first document indexed, with the fields of that document.
+    """
+    name = 'local'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False,
+                                     isolation_level=None)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._fields = {}
+
+    @staticmethod
+    def _quote(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    @staticmethod
+    def _match_expression(query):
+        """
+        Turn free text into a FTS5 query matching any of its words, so
+        that user input never reaches the FTS5 query syntax
+        """
+        words = re.findall(r'\w+', query)
+        return ' OR '.join('"' + word + '"' for word in words)
+
+    def _table_fields(self, index):
+        if index not in self._fields:
+            rows = self._conn.execute(
+                f'PRAGMA table_info({self._quote(index)})').fetchall()
+            if not rows:
+                return None
+            self._fields[index] = [row[1] for row in rows]
+        return self._fields[index]
+
+    def _ensure_table(self, index, payload):
+        fields = self._table_fields(index)
+        if fields is None:
+            fields = list(payload)
+            columns = ', '.join(self._quote(field) for field in fields)
+            self._conn.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self._quote(index)} '
+                f"USING fts5({columns}, tokenize='unicode61')")
+            self._fields[index] = fields
+        return fields
+
+    def _write(self, operations):
+        for operation in operations:
+            index = operation['index']
+            if operation['op'] == 'index':
+                fields = self._ensure_table(index, operation['body'])
+                columns = ', '.join(self._quote(field) for field in fields)
+                self._conn.execute(
+                    f'INSERT OR REPLACE INTO {self._quote(index)} (rowid, {columns}) '
+                    f'VALUES (?{", ?" * len(fields)})',
+                    [operation['id']] + [operation['body'].get(field) for field in fields])
+            elif self._table_fields(index) is not None:
+                self._conn.execute(
+                    f'DELETE FROM {self._quote(index)} WHERE rowid = ?', (operation['id'],))
+
+    def index(self, index, id, payload):
+        self.bulk([{'op': 'index', 'index': index, 'id': id, 'body': payload}])
+
+    def delete(self, index, id):
+        self.bulk([{'op': 'delete', 'index': index, 'id': id}])
+
+    def bulk(self, operations):
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._write(operations)
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def query(self, index, query, page, per_page):
+        match = self._match_expression(query)
+        table = self._quote(index)
+        with self._lock:
+            if not match or self._table_fields(index) is None:
+                return [], 0
+            total = self._conn.execute(
+                f'SELECT count(*) FROM {table} WHERE {table} MATCH ?', (match,)).fetchone()[0]
+            rows = self._conn.execute(
+                f'SELECT rowid FROM {table} WHERE {table} MATCH ? '
+                f'ORDER BY bm25({table}), rowid LIMIT ? OFFSET ?',
+                (match, per_page, (page - 1) * per_page)).fetchall()
+        return [row[0] for row in rows], total
+
+    def query_page(self, index, query, per_page, after=None, before=None):
+        match = self._match_expression(query)
+        # bm25() is lower for better matches, so hits are ordered by
+        # (score, id) ascending and the cursor is the [score, id] pair
+        table = self._quote(index)
+        sql = (f'SELECT id, score FROM (SELECT rowid AS id, bm25({table}) AS score '
+               f'FROM {table} WHERE {table} MATCH ?)')
+        params = [match]
+        if before is not None:
+            sql += ' WHERE score < ? OR (score = ? AND id < ?) ORDER BY score DESC, id DESC'
+            params += [before[0], before[0], before[1]]
+        elif after is not None:
+            sql += ' WHERE score > ? OR (score = ? AND id > ?) ORDER BY score, id'
+            params += [after[0], after[0], after[1]]
+        else:
+            sql += ' ORDER BY score, id'
+        params.append(per_page + 1)
+
+        with self._lock:
+            if not match or self._table_fields(index) is None:
+                return [], [], False
+            rows = self._conn.execute(sql + ' LIMIT ?', params).fetchall()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if before is not None:
+            rows.reverse()
+
+        return [row[0] for row in rows], [[row[1], row[0]] for row in rows], more
+
+    def clear(self, index):
+        """
+        Drop an index, e.g. before a full reindex
+        """
+        with self._lock:
+            self._conn.execute(f'DROP TABLE IF EXISTS {self._quote(index)}')
+            self._fields.pop(index, None)
@@ -0,0 +1,20 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+_session = None
+
+
+def http_session():
+    """
+    One pooled HTTP session per process, so that calls to external
+    services reuse their connections
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+    return _session
@@ -0,0 +1,83 @@
+from flask import current_app
+
+from app import db
+
+
+def _langdetect():
+    """
+    Import langdetect on first use, the processes never detecting a
+    language do not pay for it
+    """
+    import langdetect
+
+    # langdetect is randomized, a fixed seed makes it return the same
+    # language for the same text every time
+    langdetect.DetectorFactory.seed = 0
+    return langdetect
+
+
+def preload_profiles():
+    """
+    Load the language profiles up front instead of on the first detection
+    """
+    from langdetect.detector_factory import init_factory
+
+    _langdetect()
+    init_factory()
+
+
+def detect_language(text):
+    langdetect = _langdetect()
+    try:
+        return langdetect.detect(text)
+    except langdetect.LangDetectException:
+        return ''
+
+
+def update_post_language(post_id):
+    from app.main.models import Post
+
+    post = Post.query.get(post_id)
+    if post is None:
+        return
+    post.language = detect_language(post.body)
+    db.session.commit()
+
+
+def queue_language_detection(post):
+    """
+    Detect the language of a committed post in the background. Without a
+    task queue the detection runs right away.
+    """
+    if current_app.task_queue is None:
+        update_post_language(post.id)
+        return
+
+    current_app.task_queue.enqueue('app.tasks.detect_post_language', post.id)
+
+
+def backfill_languages(batch_size=500):
+    """
+    Detect the language of every post that has none, in batches
+    :return: the number of posts updated
+    """
+    from app.main.models import Post
+
+    table = Post.__table__
+    update = table.update().where(table.c.id == db.bindparam('post_id')).values(
+        language=db.bindparam('detected'))
+    updated, last_id = 0, 0
+    while True:
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.body).where(
+                db.or_(table.c.language.is_(None), table.c.language == ''),
+                table.c.id > last_id).order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return updated
+
+        detected = [{'post_id': row.id, 'detected': detect_language(row.body or '')}
+                    for row in rows]
+        db.session.execute(update, detected)
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
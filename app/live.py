@@ -0,0 +1,179 @@
+import json
+import queue
+import threading
+import time
+
+from flask import Response, current_app, g
+from flask_babel import force_locale
+from redis.exceptions import RedisError
+from werkzeug.exceptions import ServiceUnavailable
+
+CHANNEL = 'live:posts'
+
+
+class LocalBroker(object):
+    """
+    Hand the published posts to the connections of this process that
+    follow their author. Every connection is a bounded queue registered
+    under the ids of the users it follows, so an idle connection costs a
+    queue and a few set entries.
+    """
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.connections = 0
+
+    def subscribe(self, author_ids, maxsize=100):
+        """
+        :raise ServiceUnavailable: when this process holds too many connections
+        :return: the queue the messages of the authors are put in
+        """
+        inbox = queue.Queue(maxsize)
+        with self.lock:
+            if self.connections >= self.max_connections:
+                raise ServiceUnavailable(retry_after=30)
+            self.connections += 1
+            for author_id in author_ids:
+                self.subscribers.setdefault(author_id, set()).add(inbox)
+        return inbox
+
+    def unsubscribe(self, author_ids, inbox):
+        with self.lock:
+            self.connections -= 1
+            for author_id in author_ids:
+                inboxes = self.subscribers.get(author_id)
+                if inboxes is not None:
+                    inboxes.discard(inbox)
+                    if not inboxes:
+                        del self.subscribers[author_id]
+
+    def publish(self, message):
+        self.deliver(message)
+
+    def deliver(self, message):
+        with self.lock:
+            inboxes = list(self.subscribers.get(message['author_id'], ()))
+        for inbox in inboxes:
+            try:
+                inbox.put_nowait(message)
+            except queue.Full:
+                # a client that does not read is not worth buffering for
+                pass
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publish the posts on a redis channel. Every process holds a single
+    subscription, listened to by a background thread started with the
+    first connection, and delivers the messages to its own connections.
+    """
+    def __init__(self, redis, max_connections, logger):
+        super(RedisBroker, self).__init__(max_connections)
+        self.redis = redis
+        self.logger = logger
+        self.listener = None
+
+    def subscribe(self, author_ids, maxsize=100):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self._listen, daemon=True)
+                self.listener.start()
+        return super(RedisBroker, self).subscribe(author_ids, maxsize)
+
+    def publish(self, message):
+        try:
+            self.redis.publish(CHANNEL, json.dumps(message))
+        except RedisError:
+            # the post is committed already, its readers see it on reload
+            self.logger.exception('Publishing a live update failed')
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for item in pubsub.listen():
+                    self.deliver(json.loads(item['data']))
+            except Exception:
+                self.logger.exception('Live updates subscription lost')
+                time.sleep(1)
+
+
+def _event(message, locale):
+    data = json.dumps({'id': message['post_id'], 'html': message['html'].get(locale, '')})
+    return f"id: {message['post_id']}\nevent: post\ndata: {data}\n\n"
+
+
+class LiveUpdates(object):
+    """
+    Push the new posts of the followed users to the home pages of their
+    readers as server-sent events.
+
+    The fragments are rendered once per language when the post is
+    published, so the open connections never touch the database nor the
+    templates.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        max_connections = app.config['LIVE_MAX_CONNECTIONS']
+        app.extensions['live_updates'] = RedisBroker(app.redis, max_connections, app.logger) \
+            if app.redis is not None else LocalBroker(max_connections)
+
+    @staticmethod
+    def _broker():
+        return current_app.extensions['live_updates']
+
+    def publish(self, post):
+        """
+        Send a committed post to the connected followers of its author
+        """
+        from app.main.fragments import render_post
+
+        html = {}
+        locale = g.get('locale')
+        for language in current_app.config['LANGUAGES']:
+            with force_locale(language):
+                g.locale = language
+                html[language] = str(render_post(post))
+        g.locale = locale
+        self._broker().publish({'author_id': post.user_id, 'post_id': post.id, 'html': html})
+
+    def stream(self, user, locale):
+        """
+        :return: a streaming Response of the posts published by the user
+            and by the users they follow
+        """
+        from app import db
+        from app.main.models import followers
+
+        author_ids = {user.id} | {followed_id for followed_id, in db.session.query(
+            followers.c.followed_id).filter(followers.c.follower_id == user.id)}
+        broker = self._broker()
+        inbox = broker.subscribe(author_ids)
+
+        heartbeat = current_app.config['LIVE_HEARTBEAT_SECONDS']
+        # ending the stream now and then makes the client reconnect, which
+        # picks up the follows made since and spreads the connections
+        # over the processes again
+        deadline = time.monotonic() + current_app.config['LIVE_MAX_SECONDS']
+
+        def events():
+            yield 'retry: 2000\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    message = inbox.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                else:
+                    yield _event(message, locale)
+
+        response = Response(events(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # do not let a proxy buffer the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(lambda: broker.unsubscribe(author_ids, inbox))
+        return response
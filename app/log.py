@@ -0,0 +1,151 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import time
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import current_app, g, has_request_context, request
+from flask.logging import default_handler
+
+
+def request_id():
+    """
+    :return: the id of the current request, or None outside of requests
+    """
+    if not has_request_context():
+        return None
+    return g.get('request_id')
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Stamp the records with the id of the request that logged them. It has
+    to run on the request thread, before the record is queued.
+    """
+    def filter(self, record):
+        record.request_id = request_id()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record. The `fields` dict passed in the extra
+    argument of the logging call is merged into the object.
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'location': f'{record.pathname}:{record.lineno}',
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        data.update(getattr(record, 'fields', None) or {})
+        return json.dumps(data, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        """
+        Keep the traceback apart from the message, unlike QueueHandler, so
+        that the handlers behind the queue can format it on their own
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestLogging(object):
+    """
+    Request ids, a sampled access log and logging off the request threads.
+
+    Every request gets an id, taken from the X-Request-ID header when the
+    client or a proxy sent one and returned in the response. The access log
+    records an ACCESS_LOG_SAMPLE_RATE fraction of the requests, and every
+    server error. start() puts the slow handlers behind a queue, written by
+    a background thread, so that requests never wait for the disk or the
+    mail server.
+    """
+    def __init__(self, app=None):
+        self.logger = None
+        self.queue_handler = None
+        self.listener = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ACCESS_LOG_SAMPLE_RATE', 0.01)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+
+    @staticmethod
+    def _start_request():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.request_start = time.perf_counter()
+
+    @staticmethod
+    def _end_request(response):
+        if 'request_id' not in g:
+            return response
+        response.headers.setdefault('X-Request-ID', g.request_id)
+        if response.status_code < 500 and \
+                random.random() >= current_app.config['ACCESS_LOG_SAMPLE_RATE']:
+            return response
+        logging.getLogger(current_app.logger.name + '.access').info(
+            '%s %s %s', request.method, request.full_path, response.status_code,
+            extra={'fields': {
+                'method': request.method,
+                'path': request.full_path,
+                'status': response.status_code,
+                'duration': time.perf_counter() - g.request_start,
+                'remote_addr': request.remote_addr,
+                'user_agent': request.user_agent.string,
+            }})
+        return response
+
+    def start(self, app, *handlers):
+        """
+        Attach handlers to the app logger through a queue and start the
+        thread writing the queued records to them. The stderr handler of
+        flask is removed, it would still write from the requests. The app
+        logger is shared by the apps of the process, so the queue of a
+        previous start is stopped first.
+        """
+        if self.listener is None:
+            atexit.register(self.stop)
+        self.stop()
+        records = queue.Queue(-1)
+        self.queue_handler = _QueueHandler(records)
+        self.queue_handler.addFilter(RequestIdFilter())
+        self.logger = app.logger
+        self.logger.removeHandler(default_handler)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = QueueListener(records, *handlers, respect_handler_level=True)
+        self.listener.start()
+        return self.listener
+
+    def stop(self):
+        """
+        Write the queued records, detach the queue from the app logger and
+        give it back the stderr handler of flask
+        """
+        if self.queue_handler is None:
+            return
+        self.logger.removeHandler(self.queue_handler)
+        self.logger.addHandler(default_handler)
+        self.listener.stop()
+        self.queue_handler = None
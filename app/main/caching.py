@@ -0,0 +1,143 @@
+from functools import wraps
+from hashlib import sha1
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from redis.exceptions import RedisError
+
+from app import db
+from app.cache import LRUCache, RedisCache, TieredCache
+from app.main.models import Post, User
+
+
+def _cache():
+    cache = current_app.extensions.get('response_cache')
+    if cache is None:
+        ttl = current_app.config['RESPONSE_CACHE_TTL']
+        shared = None
+        if current_app.redis is not None:
+            shared = RedisCache(current_app.redis, 'response:', ttl)
+        cache = TieredCache(LRUCache(current_app.config['RESPONSE_CACHE_SIZE'], ttl), shared)
+        current_app.extensions['response_cache'] = cache
+    return cache
+
+
+def _versions():
+    return current_app.extensions.setdefault('response_cache_versions', {})
+
+
+def tag_version(tag):
+    """
+    Cached responses are keyed by the versions of their tags, so bumping a
+    version invalidates every response carrying the tag. With redis the
+    versions are shared by all the processes.
+    :return: the version, or None when redis cannot be reached
+    """
+    if current_app.redis is not None:
+        try:
+            return int(current_app.redis.get('response:tag:' + tag) or 0)
+        except RedisError:
+            return None
+    return _versions().get(tag, 0)
+
+
+def invalidate(*tags):
+    """
+    Bump the versions of the tags. A redis error is logged, the changes
+    are committed already and the cached responses expire on their own.
+    """
+    for tag in tags:
+        if current_app.redis is not None:
+            try:
+                current_app.redis.incr('response:tag:' + tag)
+            except RedisError:
+                current_app.logger.exception('Invalidating cached responses failed')
+                return
+        else:
+            versions = _versions()
+            versions[tag] = versions.get(tag, 0) + 1
+
+
+def cache_anonymous(tags, last_modified):
+    """
+    Serve anonymous GET requests of the decorated view from a short lived
+    server side cache, and answer conditional requests with 304.
+
+    :param tags: function of the view arguments returning the tags whose
+        invalidation must drop the cached response
+    :param last_modified: function of the view arguments returning the
+        time the content last changed, or None
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if not current_app.config['RESPONSE_CACHE'] or request.method != 'GET' or \
+                    current_user.is_authenticated or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            versions = [(tag, tag_version(tag)) for tag in tags(**kwargs)]
+            if any(version is None for tag, version in versions):
+                # without the versions a cached response could be stale
+                return view(*args, **kwargs)
+            versions = ','.join(f'{tag}={version}' for tag, version in versions)
+            key = f'{request.full_path}|{g.locale}|{versions}'
+            modified = last_modified(**kwargs)
+            etag = sha1(f'{key}|{modified}'.encode('utf-8')).hexdigest()
+
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                cache = _cache()
+                cached = cache.get(key)
+                if cached is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    cached = (response.get_data(), response.mimetype)
+                    cache.set(key, cached)
+                response = current_app.response_class(cached[0], mimetype=cached[1])
+
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            response.cache_control.no_cache = True
+            response.vary.update(['Cookie', 'Accept-Language'])
+            return response.make_conditional(request)
+        return wrapped
+    return decorator
+
+
+def newest_post():
+    return db.session.query(db.func.max(Post.timestamp)).scalar()
+
+
+def newest_post_of(username):
+    return db.session.query(db.func.max(Post.timestamp)).join(
+        User, User.id == Post.user_id).filter(User.username == username).scalar()
+
+
+@db.event.listens_for(Post, 'after_insert')
+@db.event.listens_for(Post, 'after_delete')
+def invalidate_post_listings(mapper, connection, post):
+    """
+    Record the listings showing the post. They are only invalidated once
+    the transaction commits, so that a request caching them in between
+    cannot keep the old page under the new versions.
+    """
+    user = User.__table__
+    username = connection.execute(
+        db.select(user.c.username).where(user.c.id == post.user_id)).scalar()
+    tags = db.object_session(post).info.setdefault('invalidated_tags', set())
+    tags.update(('explore', f'user:{username}'))
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_committed_listings(session):
+    tags = session.info.pop('invalidated_tags', None)
+    if tags:
+        invalidate(*tags)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_rolled_back_listings(session):
+    session.info.pop('invalidated_tags', None)
@@ -0,0 +1,52 @@
+from flask import current_app, g, render_template
+from markupsafe import Markup
+
+from app.avatars import email_digest
+from app.cache import LRUCache, RedisCache, TieredCache
+from app.main import bp
+
+
+def _cache():
+    cache = current_app.extensions.get('post_fragment_cache')
+    if cache is None:
+        ttl = current_app.config['POST_FRAGMENT_CACHE_TTL']
+        shared = None
+        if current_app.redis is not None:
+            shared = RedisCache(current_app.redis, 'fragment:post:', ttl)
+        cache = TieredCache(LRUCache(current_app.config['POST_FRAGMENT_CACHE_SIZE'], ttl), shared)
+        current_app.extensions['post_fragment_cache'] = cache
+    return cache
+
+
+def fragment_key(post):
+    """
+    A post body never changes, so its rendered html only depends on the
+    locale, on the author's username, email and avatar setting and on the
+    detected language. A rename or an email change gives the author's posts
+    new keys, so stale fragments are never served.
+    """
+    author = post.author
+    avatar = author.email_hash or email_digest(author.email)
+    proxied = 'p' if current_app.config['AVATAR_PROXY'] else 'g'
+    return f'{post.id}:{g.locale}:{post.language or ""}:{author.username}:{avatar}:{proxied}'
+
+
+def render_post(post):
+    """
+    Render _post.html for one post, from the fragment cache when possible
+    """
+    if not current_app.config['POST_FRAGMENT_CACHE']:
+        return Markup(render_template('_post.html', post=post))
+
+    cache = _cache()
+    key = fragment_key(post)
+    html = cache.get(key)
+    if html is None:
+        html = render_template('_post.html', post=post)
+        cache.set(key, html)
+    return Markup(html)
+
+
+@bp.app_context_processor
+def inject_render_post():
+    return {'render_post': render_post}
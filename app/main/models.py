@@ -1,15 +1,20 @@
+import base64
+import os
 from time import time
-from datetime import datetime
-from hashlib import md5
-
-from flask import current_app
+from datetime import datetime, timedelta
+from flask import current_app, url_for
 from flask_login import UserMixin
-from werkzeug.security import check_password_hash, generate_password_hash
 
 import jwt
 
 from app import db, login
-from app.search import add_to_index, query_index, remove_from_index
+from app.avatars import email_digest, gravatar_url
+from app.main.pagination import CursorPage, KeysetPagination, encode_cursor
+from app.passwords import hash_password, needs_rehash, verify_password
+from app.search import (
+    bulk_index, delete_operation, index_operation, query_index, query_index_page,
+    queue_index_operations
+)
 
 
 @login.user_loader
@@ -17,9 +22,23 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 
+# The primary key serves the follower -> followed lookups and rejects
+# duplicate follows, the reverse index serves followed -> followers.
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
+)
+
+# Materialized home timeline: one row per (reader, post). Rows are written
+# when a post is created (fan-out on write) and when a user follows someone,
+# so that the home page reads a single (user_id, timestamp) index range.
+timeline = db.Table('timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp')
 )
 
 
@@ -45,65 +64,109 @@ class SearchableMixin(object):
         for i in range(len(ids)):
             when.append((ids[i], i))
 
-        return cls.query.filter(cls.id.in_(ids)).order_by(
+        return cls.query.options(*cls.search_load_options()).filter(cls.id.in_(ids)).order_by(
             db.case(when, value=cls.id)), total
 
+    @classmethod
+    def search_page(cls, expression, per_page, after=None, before=None):
+        """
+        Cursor based variant of search, `after` and `before` are the decoded
+        cursors of the page the client is coming from
+        :return: CursorPage
+        """
+        ids, sort_values, more = query_index_page(
+            cls.__tablename__, expression, per_page, after=after, before=before)
+        if not ids:
+            return CursorPage([], False, before is not None)
+
+        objects = {obj.id: obj for obj in cls.query.options(
+            *cls.search_load_options()).filter(cls.id.in_(ids))}
+        items = [objects[i] for i in ids if i in objects]
+
+        if before is not None:
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, after is not None
+
+        return CursorPage(
+            items, has_next, has_prev,
+            next_cursor=encode_cursor(sort_values[-1]) if has_next else None,
+            prev_cursor=encode_cursor(sort_values[0]) if has_prev else None)
+
 
     @classmethod
-    def before_commit(cls, session):
+    def search_load_options(cls):
         """
-        record all the new changes in the session before commit
+        Loader options applied when hydrating search hits, override to
+        eager load the relationships the results are rendered with
         """
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+        return ()
 
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        record the changes of every flush of the transaction, the objects
+        flushed before the commit are no longer pending by then
+        """
+        changes = session.info.setdefault('search_changes', {'add': [], 'update': [], 'delete': []})
+        changes['add'].extend(session.new)
+        changes['update'].extend(session.dirty)
+        changes['delete'].extend(session.deleted)
 
     @classmethod
     def after_commit(cls, session):
         """
-        apply the new changes to the elasticsearch index after commit.
+        queue the new changes for the elasticsearch index after commit.
         """
-        if session._changes['add']:
-            for obj in session._changes['add']:
-                if isinstance(obj, SearchableMixin):
-                    add_to_index(cls.__tablename__, obj)
+        changes = session.info.pop('search_changes', None)
+        if changes is None:
+            return
+        operations = []
+        for obj in changes['add'] + changes['update']:
+            if isinstance(obj, SearchableMixin):
+                operations.append(index_operation(obj.__tablename__, obj))
 
-        if session._changes['update']:
-            for obj in session._changes['update']:
-                if isinstance(obj, SearchableMixin):
-                    add_to_index(cls.__tablename__, obj)
+        for obj in changes['delete']:
+            if isinstance(obj, SearchableMixin):
+                operations.append(delete_operation(obj.__tablename__, obj))
 
-        if session._changes['delete']:
-            for obj in session._changes['delete']:
-                if isinstance(obj, SearchableMixin):
-                    remove_from_index(cls.__tablename__, obj)
-<<<<<<< HEAD
-        session._changes = None
-=======
->>>>>>> c7ffcde9f9d0ba055e1b9151db0c8dd7f7b96dfd
+        queue_index_operations(operations)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
 
-<<<<<<< HEAD
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    @classmethod
+    def reindex(cls, chunk_size=None):
+        """
+        Stream every row to the index in bulk requests of chunk_size documents
+        """
+        chunk_size = chunk_size or current_app.config['SEARCH_BULK_SIZE']
+        operations = []
+        for obj in cls.query.order_by(cls.id).yield_per(chunk_size):
+            operations.append(index_operation(cls.__tablename__, obj))
+            if len(operations) >= chunk_size:
+                bulk_index(operations)
+                operations = []
+        bulk_index(operations)
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
-=======
-
->>>>>>> c7ffcde9f9d0ba055e1b9151db0c8dd7f7b96dfd
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    email_hash = db.Column(db.String(32))
     about_me = db.Column(db.String(150))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     password_hash = db.Column(db.String(128))
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    token = db.Column(db.String(32), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     followed = db.relationship(
         'User',
@@ -123,7 +186,7 @@ class User(UserMixin, db.Model):
         :param password:
         :return: None
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
         """
@@ -131,24 +194,68 @@ class User(UserMixin, db.Model):
         :param password:
         :return: bool
         """
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        """
+        Whether the password hash was made with outdated parameters
+        :return: bool
+        """
+        return needs_rehash(self.password_hash)
+
+    @db.validates('email')
+    def validate_email(self, key, email):
+        """
+        Keep the gravatar hash of the email in sync with it
+        """
+        self.email_hash = email_digest(email) if email else None
+        return email
 
     def avatar(self, size):
-        hexdigest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        url = f"https://www.gravatar.com/avatar/{hexdigest}?s={size}&d=identicon"
-        return url
+        hexdigest = self.email_hash or email_digest(self.email)
+        if current_app.config['AVATAR_PROXY']:
+            return url_for('main.avatar', hexdigest=hexdigest, size=size)
+        return gravatar_url(hexdigest, size)
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))).scalar()
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
+            self._backfill_timeline(user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
+            self._trim_timeline(user)
+
+    def _backfill_timeline(self, user):
+        """
+        Copy the most recent posts of a newly followed user into the timeline
+        """
+        already = db.select(timeline.c.post_id).where(timeline.c.user_id == self.id)
+        recent = db.select(
+            db.literal(self.id), Post.id, Post.timestamp).where(
+                Post.user_id == user.id, Post.id.not_in(already)).order_by(
+                    Post.timestamp.desc()).limit(
+                        current_app.config['TIMELINE_BACKFILL'])
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], recent))
+
+    def _trim_timeline(self, user):
+        """
+        Remove the posts of an unfollowed user from the timeline
+        """
+        authored = db.select(Post.id).where(Post.user_id == user.id)
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id, timeline.c.post_id.in_(authored)))
 
     def followed_posts(self):
         followed = Post.query.join(
@@ -159,6 +266,96 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline(self):
+        """
+        Return the posts of the user's home timeline, newest first.
+
+        Posts are read from the materialized timeline table. Posts of followed
+        users with too many followers to fan out on write are merged in here
+        at read time instead.
+        :return: Query
+        """
+        query, keys = self._timeline_query()
+        return query.order_by(keys[0].desc(), keys[1].desc())
+
+    def timeline_page(self, per_page, after=None, before=None):
+        """
+        Return one page of the home timeline addressed by post cursors
+        :return: KeysetPagination
+        """
+        query, keys = self._timeline_query()
+        return KeysetPagination(query, per_page, after=after, before=before, keys=keys)
+
+    def _timeline_query(self):
+        """
+        :return: tuple(unordered Query, the (timestamp, id) columns to order it by)
+        """
+        pushed = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id)
+
+        pulled_ids = self.followed_fanout_exempt_ids()
+        if not pulled_ids:
+            return pushed.options(db.joinedload(Post.author)), \
+                (timeline.c.timestamp, timeline.c.post_id)
+
+        pulled = Post.query.filter(Post.user_id.in_(pulled_ids))
+        return pushed.union(pulled).options(db.joinedload(Post.author)), \
+            (Post.timestamp, Post.id)
+
+    def followed_fanout_exempt_ids(self):
+        """
+        Ids of the followed users whose posts are not fanned out on write
+        """
+        threshold = current_app.config['TIMELINE_FANOUT_LIMIT']
+        return [user_id for user_id, in db.session.query(User.id).join(
+            followers, followers.c.followed_id == User.id).filter(
+                followers.c.follower_id == self.id,
+                User.follower_count > threshold)]
+
+    def is_fanout_exempt(self):
+        """
+        Whether this user has too many followers to fan out posts on write
+        """
+        return self.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def reconcile_counters():
+        """
+        Recompute the follower, followed and post counters of every user
+        in a single UPDATE
+        """
+        user = User.__table__
+        count = db.select(db.func.count())
+        db.session.execute(user.update().values(
+            follower_count=count.select_from(followers).where(
+                followers.c.followed_id == user.c.id).scalar_subquery(),
+            followed_count=count.select_from(followers).where(
+                followers.c.follower_id == user.c.id).scalar_subquery(),
+            post_count=count.select_from(Post.__table__).where(
+                Post.__table__.c.user_id == user.c.id).scalar_subquery()))
+        db.session.commit()
+
+    @staticmethod
+    def rebuild_timelines():
+        """
+        Recompute every home timeline from the posts and the follow graph,
+        as fan_out would have written them. The counters must be up to date
+        for the fan-out exempt users to be left out.
+        """
+        post = Post.__table__
+        db.session.execute(timeline.delete())
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select(post.c.user_id, post.c.id, post.c.timestamp)))
+        fanned_out = db.select(User.__table__.c.id).where(
+            User.__table__.c.follower_count <= current_app.config['TIMELINE_FANOUT_LIMIT'])
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select(followers.c.follower_id, post.c.id, post.c.timestamp).select_from(
+                followers.join(post, post.c.user_id == followers.c.followed_id)).where(
+                    post.c.user_id.in_(fanned_out))))
+        db.session.commit()
+
     def get_password_reset_token(self):
         payload = {'reset_password': self.id, 'exp': time() + 600}
         token = jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm='HS256')
@@ -174,9 +371,50 @@ class User(UserMixin, db.Model):
 
         return User.query.get(user_id)
 
+    def to_dict(self, include_email=False):
+        data = {
+            'id': self.id,
+            'username': self.username,
+            'about_me': self.about_me,
+            'last_seen': self.last_seen.isoformat() + 'Z' if self.last_seen else None,
+            'post_count': self.post_count,
+            'follower_count': self.follower_count,
+            'followed_count': self.followed_count,
+            'avatar': self.avatar(128),
+        }
+        if include_email:
+            data['email'] = self.email
+        return data
+
+    def get_token(self, expires_in=3600):
+        """
+        Return the API token of the user, issuing a new one when the current
+        token expires within a minute
+        """
+        now = datetime.utcnow()
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
+            return self.token
+        self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token=token).first()
+        if user is None or user.token_expiration < datetime.utcnow():
+            return None
+        return user
+
 
 class Post(db.Model, SearchableMixin):
     __searchable__ = ['body']
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(256))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -185,3 +423,52 @@ class Post(db.Model, SearchableMixin):
 
     def __repr__(self):
         return f"<Post '{self.body}'>"
+
+    @classmethod
+    def search_load_options(cls):
+        return (db.joinedload(cls.author),)
+
+    def to_dict(self):
+        """
+        The author must be loaded along with the post to serialize lists of
+        posts without a query per post
+        """
+        return {
+            'id': self.id,
+            'body': self.body,
+            'timestamp': self.timestamp.isoformat() + 'Z',
+            'language': self.language,
+            'author': {'id': self.author.id, 'username': self.author.username},
+        }
+
+    def fan_out(self):
+        """
+        Push the post into the timeline of its author and, unless the author
+        has too many followers, into the timelines of all their followers.
+        The post must already be flushed so that it has an id.
+        """
+        db.session.execute(timeline.insert().values(
+            user_id=self.user_id, post_id=self.id, timestamp=self.timestamp))
+
+        if self.author.is_fanout_exempt():
+            return
+
+        readers = db.select(
+            followers.c.follower_id, db.literal(self.id), db.literal(self.timestamp)).where(
+                followers.c.followed_id == self.user_id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], readers))
+
+
+@db.event.listens_for(Post, 'after_insert')
+def increment_post_count(mapper, connection, post):
+    user = User.__table__
+    connection.execute(user.update().where(user.c.id == post.user_id).values(
+        post_count=user.c.post_count + 1))
+
+
+@db.event.listens_for(Post, 'after_delete')
+def decrement_post_count(mapper, connection, post):
+    user = User.__table__
+    connection.execute(user.update().where(user.c.id == post.user_id).values(
+        post_count=user.c.post_count - 1))
@@ -0,0 +1,153 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, request, url_for
+
+from app import db
+
+
+def encode_cursor(values):
+    """
+    Turn a list of sort key values into an opaque url safe token
+    :param values: list of json serializable values
+    :return: str
+    """
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Reverse of encode_cursor, aborts with 400 when the token is malformed
+    :param cursor: str
+    :return: list
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, binascii.Error, UnicodeError):
+        abort(400)
+    if not isinstance(values, list):
+        abort(400)
+    return values
+
+
+def post_cursor(post):
+    return encode_cursor([post.timestamp.isoformat(), post.id])
+
+
+def decode_post_cursor(cursor):
+    """
+    Decode a (timestamp, id) post cursor
+    :return: tuple(datetime, int) or None
+    """
+    if not cursor:
+        return None
+    values = decode_cursor(cursor)
+    try:
+        timestamp, post_id = values
+        return datetime.fromisoformat(timestamp), int(post_id)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def decode_search_cursor(cursor):
+    """
+    Decode a [score, id] search cursor. Elasticsearch reports the id sort
+    value as a string of digits, the local engine as an int.
+    :return: list or None
+    """
+    if not cursor:
+        return None
+    values = decode_cursor(cursor)
+    if len(values) != 2:
+        abort(400)
+    score, ident = values
+    if isinstance(score, bool) or not isinstance(score, (int, float)):
+        abort(400)
+    if isinstance(ident, bool) or not (isinstance(ident, int) or
+                                       isinstance(ident, str) and ident.isdigit()):
+        abort(400)
+    return values
+
+
+class CursorPage(object):
+    """
+    A page of results addressed by cursors instead of page numbers. Unlike
+    flask_sqlalchemy's Pagination it never knows the total number of items.
+    """
+    def __init__(self, items, has_next, has_prev, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+class KeysetPagination(CursorPage):
+    """
+    Paginate a query of posts, newest first, by seeking on a
+    (timestamp, id) pair instead of using OFFSET.
+
+    `keys` are the two columns the query is ordered by. They default to the
+    post columns but can be any columns holding the same values, so that the
+    seek can use the index of a joined table.
+    """
+    def __init__(self, query, per_page, after=None, before=None, keys=None):
+        from app.main.models import Post
+
+        timestamp, ident = keys or (Post.timestamp, Post.id)
+        query = query.order_by(None)
+
+        if before is not None:
+            query = query.filter(db.or_(
+                timestamp > before[0],
+                db.and_(timestamp == before[0], ident > before[1])))
+            rows = query.order_by(timestamp.asc(), ident.asc()).limit(per_page + 1).all()
+            items = rows[:per_page][::-1]
+            has_next, has_prev = bool(items), len(rows) > per_page
+        else:
+            if after is not None:
+                query = query.filter(db.or_(
+                    timestamp < after[0],
+                    db.and_(timestamp == after[0], ident < after[1])))
+            rows = query.order_by(timestamp.desc(), ident.desc()).limit(per_page + 1).all()
+            items = rows[:per_page]
+            has_next, has_prev = len(rows) > per_page, after is not None and bool(items)
+
+        super(KeysetPagination, self).__init__(
+            items, has_next, has_prev,
+            next_cursor=post_cursor(items[-1]) if has_next else None,
+            prev_cursor=post_cursor(items[0]) if has_prev else None)
+
+
+def cursor_args():
+    """
+    Read the `after` and `before` post cursors of the current request
+    """
+    return {
+        'after': decode_post_cursor(request.args.get('after')),
+        'before': decode_post_cursor(request.args.get('before'))
+    }
+
+
+def pager_urls(endpoint, posts, **values):
+    """
+    Build the next and previous urls for either a page number based
+    Pagination or a CursorPage
+    :return: tuple(next_url, prev_url)
+    """
+    if isinstance(posts, CursorPage):
+        next_url = url_for(endpoint, after=posts.next_cursor, **values) \
+            if posts.has_next else None
+        prev_url = url_for(endpoint, before=posts.prev_cursor, **values) \
+            if posts.has_prev else None
+    else:
+        next_url = url_for(endpoint, page=posts.next_num, **values) \
+            if posts.has_next else None
+        prev_url = url_for(endpoint, page=posts.prev_num, **values) \
+            if posts.has_prev else None
+
+    return next_url, prev_url
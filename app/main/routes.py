@@ -1,29 +1,34 @@
+import re
+from collections import defaultdict
 from datetime import datetime
 
 from flask import (
     render_template, redirect, url_for, flash, request, g,
-    current_app
+    current_app, abort, make_response
     )
 from flask_babel import _, get_locale
 from flask_login import current_user, login_user, logout_user, login_required
-from langdetect import detect, LangDetectException
+from sqlalchemy.exc import IntegrityError
 from werkzeug.urls import url_parse
 
-from app import db
+from app import db, last_seen, live_updates
+from app.avatars import fetch_avatar, gravatar_url
+from app.language import queue_language_detection
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
 
 
+from app.main.caching import cache_anonymous, invalidate, newest_post, newest_post_of
 from app.main.models import User, Post
+from app.main.pagination import KeysetPagination, cursor_args, decode_search_cursor, pager_urls
 from app.main import bp
-from app.translate import translate
+from app.translate import translate, translate_batch
 
 
 @bp.before_request
 def before_request():
     g.locale = str(get_locale())
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user.id, datetime.utcnow())
         g.search_form = SearchForm()
 
 
@@ -32,50 +37,72 @@ def before_request():
 @login_required
 def index():
     form = PostForm()
-    page = request.args.get('page', 1, int)
-    posts = current_user.followed_posts().paginate(page, current_app.config['POST_PER_PAGE'], False)
-
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    page = request.args.get('page', None, int)
+    if page:
+        posts = current_user.timeline().paginate(page, current_app.config['POST_PER_PAGE'], False)
+    else:
+        posts = current_user.timeline_page(current_app.config['POST_PER_PAGE'], **cursor_args())
+    next_url, prev_url = pager_urls('main.index', posts)
 
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        db.session.flush()
+        post.fan_out()
         db.session.commit()
+        queue_language_detection(post)
+        live_updates.publish(post)
         flash(_("Your Post is now live!"))
 
         return redirect(url_for('main.index'))
 
+    # only the newest page is kept up to date with the new posts
+    live_url = url_for('main.live') if not page and not prev_url else None
     return render_template('index.html', title="Home", posts=posts.items,
-                           form=form, next_url=next_url, prev_url=prev_url)
+                           form=form, next_url=next_url, prev_url=prev_url,
+                           live_url=live_url)
+
+
+@bp.route('/live')
+@login_required
+def live():
+    """
+    Stream the new posts of the home timeline as server-sent events
+    """
+    return live_updates.stream(current_user, g.locale)
 
 
 @bp.route('/explore')
+@cache_anonymous(tags=lambda: ['explore'], last_modified=newest_post)
 def explore():
-    page = request.args.get('page', 1, int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POST_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    page = request.args.get('page', None, int)
+    if page:
+        posts = Post.query.options(db.joinedload(Post.author)).order_by(Post.timestamp.desc()).\
+            paginate(page, current_app.config['POST_PER_PAGE'], False)
+    else:
+        posts = KeysetPagination(Post.query.options(db.joinedload(Post.author)),
+                                 current_app.config['POST_PER_PAGE'], **cursor_args())
+    next_url, prev_url = pager_urls('main.explore', posts)
 
     return render_template('index.html', title="Home", posts=posts.items, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route("/user/<username>")
+@cache_anonymous(tags=lambda username: [f'user:{username}'], last_modified=newest_post_of)
 def profile(username):
     form = EmptyForm()
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, int)
-    posts = Post.query.filter_by(author=user).\
-        order_by(Post.timestamp.desc()).paginate(page, current_app.config['POST_PER_PAGE'], False)
-    next_url = url_for('main.profile', page=posts.next_num, username=user.username) if posts.has_next else None
-    prev_url = url_for('main.profile', page=posts.prev_num, username=user.username) if posts.has_prev else None
+    page = request.args.get('page', None, int)
+    if page:
+        posts = Post.query.filter_by(author=user).\
+            order_by(Post.timestamp.desc()).paginate(page, current_app.config['POST_PER_PAGE'], False)
+    else:
+        posts = KeysetPagination(Post.query.filter_by(author=user),
+                                 current_app.config['POST_PER_PAGE'], **cursor_args())
+    next_url, prev_url = pager_urls('main.profile', posts, username=user.username)
 
     return render_template("profile.html", user=user, form=form, posts=posts.items,
+                           last_seen=last_seen.get(user.id) or user.last_seen,
                            title="Profile", next_url=next_url, prev_url=prev_url)
 
 
@@ -83,6 +110,7 @@ def profile(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        invalidate(f'user:{current_user.username}', f'user:{form.username.data}', 'explore')
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.add(current_user)
@@ -124,7 +152,14 @@ def follow(username):
             return redirect(url_for('main.profile', username=username))
 
         current_user.follow(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request recorded the same follow first
+            db.session.rollback()
+            flash(f"You are already following {username}")
+            return redirect(url_for('main.profile', username=username))
+        invalidate(f'user:{username}', f'user:{current_user.username}')
         flash(_("You are now following %(username)s", username=username))
         return redirect(url_for('main.profile', username=username))
 
@@ -148,6 +183,7 @@ def unfollow(username):
 
         current_user.unfollow(user)
         db.session.commit()
+        invalidate(f'user:{username}', f'user:{current_user.username}')
         flash(_("You are not following %(username)s", username=username))
         return redirect(url_for('main.profile', username=username))
 
@@ -161,17 +197,83 @@ def translate_text():
                               request.form['dest_language'])}
 
 
+@bp.route('/translate_batch', methods=['POST'])
+@login_required
+def translate_batch_text():
+    """
+    Translate all the posts visible on a page at once. Expects a json body
+    {"dest_language": ..., "items": [{"id": ..., "text": ..., "source_language": ...}]}
+    and makes one upstream call per source language.
+
+    :return: {"translations": {id: text}}
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    dest_language = data.get('dest_language')
+    if not dest_language or not isinstance(dest_language, str) or \
+            not isinstance(items, list) or \
+            len(items) > current_app.config['TRANSLATION_BATCH_LIMIT']:
+        abort(400)
+
+    groups = defaultdict(list)
+    for item in items:
+        if not isinstance(item, dict) or not {'id', 'text', 'source_language'} <= item.keys():
+            abort(400)
+        if not isinstance(item['text'], str) or not isinstance(item['source_language'], str) or \
+                not isinstance(item['id'], (str, int)) or isinstance(item['id'], bool):
+            abort(400)
+        groups[item['source_language']].append(item)
+
+    translations = {}
+    for source_language, group in groups.items():
+        texts = translate_batch([item['text'] for item in group], source_language, dest_language)
+        for i, item in enumerate(group):
+            translations[item['id']] = texts if isinstance(texts, str) else texts[i]
+
+    return {'translations': translations}
+
+
 @bp.route('/search')
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
 
-    page = request.args.get('page', 1, int)
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config['POST_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page+1) \
-        if total > page * current_app.config['POST_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page-1) \
-        if page > 1 else None
+    page = request.args.get('page', None, int)
+    if page:
+        posts, total = Post.search(g.search_form.q.data, page, current_app.config['POST_PER_PAGE'])
+        next_url = url_for('main.search', q=g.search_form.q.data, page=page+1) \
+            if total > page * current_app.config['POST_PER_PAGE'] else None
+        prev_url = url_for('main.search', q=g.search_form.q.data, page=page-1) \
+            if page > 1 else None
+    else:
+        results = Post.search_page(
+            g.search_form.q.data, current_app.config['POST_PER_PAGE'],
+            after=decode_search_cursor(request.args.get('after')),
+            before=decode_search_cursor(request.args.get('before')))
+        posts = results.items
+        next_url, prev_url = pager_urls('main.search', results, q=g.search_form.q.data)
 
     return render_template('search.html', title=_("Search"), posts=posts,
                             next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/avatar/<hexdigest>/<int:size>')
+def avatar(hexdigest, size):
+    """
+    Serve a gravatar image from the local cache, falling back to a redirect
+    to gravatar when it can not be fetched
+    """
+    if not re.fullmatch('[0-9a-f]{32}', hexdigest) or not 1 <= size <= 512:
+        abort(404)
+
+    image = fetch_avatar(hexdigest, size)
+    if image is None:
+        return redirect(gravatar_url(hexdigest, size))
+
+    content, mimetype, etag = image
+    response = make_response(content)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['AVATAR_CACHE_TTL']
+    return response.make_conditional(request)
@@ -0,0 +1,15 @@
+from flask import current_app, jsonify
+
+from app import pool_metrics, telemetry
+from app.metrics import bp
+
+
+@bp.route('')
+def metrics():
+    return current_app.response_class(
+        telemetry.render(current_app), mimetype='text/plain; version=0.0.4')
+
+
+@bp.route('/pool')
+def pool():
+    return jsonify(pool_metrics.snapshot(current_app))
@@ -0,0 +1,85 @@
+import threading
+from concurrent import futures
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+)
+
+
+class HashingBusy(ServiceUnavailable):
+    description = 'Too many password checks are in progress, please try again.'
+
+
+class _Hasher(object):
+    """
+    Password hashing on a few threads, so that a burst of logins can only
+    take PASSWORD_HASH_WORKERS cores, however many requests are served.
+    hashlib releases the GIL while deriving keys, so the threads hash in
+    parallel and the request threads only wait for their result.
+    """
+    def __init__(self, workers, queue_size, timeout):
+        self.executor = futures.ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.timeout = timeout
+
+    def run(self, func, *args):
+        # fail fast instead of queueing requests behind a full pool
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy(retry_after=1)
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            raise HashingBusy(retry_after=1)
+
+
+def _hasher():
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is None:
+        config = current_app.config
+        hasher = current_app.extensions['password_hasher'] = _Hasher(
+            config['PASSWORD_HASH_WORKERS'], config['PASSWORD_HASH_QUEUE'],
+            config['PASSWORD_HASH_TIMEOUT'])
+    return hasher
+
+
+def hash_password(password):
+    """
+    :raise HashingBusy: if the hashing pool and its queue are full
+    """
+    return _hasher().run(generate_password_hash, password,
+                         current_app.config['PASSWORD_HASH_METHOD'],
+                         current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    """
+    :raise HashingBusy: if the hashing pool and its queue are full
+    """
+    return _hasher().run(check_password_hash, password_hash, password)
+
+
+def _hash_method(method):
+    """
+    Spell out the iterations werkzeug uses when the method leaves them out
+    """
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2' and len(parts) == 2:
+        parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ':'.join(parts)
+
+
+def needs_rehash(password_hash):
+    """
+    Whether the hash was made with other parameters than the configured ones
+    """
+    method, salt, _ = password_hash.split('$', 2)
+    return _hash_method(method) != _hash_method(current_app.config['PASSWORD_HASH_METHOD']) or \
+        len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
@@ -0,0 +1,101 @@
+import json
+import time
+import uuid
+
+from flask import current_app
+from redis.exceptions import WatchError
+
+
+class FlushBusy(Exception):
+    """
+    Raised by a flush job which could not take the flush lock in time, so
+    that the job is retried
+    """
+
+
+class PendingList(object):
+    """
+    A redis list of json items handed over by the requests and sent in
+    batches by a task queue job.
+
+    A push schedules a flush job unless one is already scheduled. The jobs
+    drain the list under a lock, so that a single job at a time reads and
+    trims it, and the scheduled flag is only cleared once the list is
+    empty.
+    """
+    # seconds a flush job holds the lock for without renewing it
+    LOCK_TIMEOUT = 300
+
+    def __init__(self, prefix, job, retry_interval):
+        """
+        :param prefix: prefix of the redis keys
+        :param job: dotted name of the task that calls drain
+        :param retry_interval: seconds before the first retry of the job,
+            doubled on every retry
+        """
+        self.key = f'{prefix}:pending'
+        self.scheduled_key = f'{prefix}:flush-scheduled'
+        self.lock_key = f'{prefix}:flush-lock'
+        self.job = job
+        self.retry_interval = retry_interval
+
+    def push(self, items, retries):
+        """
+        Append items to the list and schedule a flush job if none is
+        :raise RedisError: when redis cannot be reached
+        """
+        from rq import Retry
+
+        pipe = current_app.redis.pipeline()
+        pipe.rpush(self.key, *[json.dumps(item) for item in items])
+        pipe.set(self.scheduled_key, 1, nx=True, ex=self.LOCK_TIMEOUT)
+        _, schedule = pipe.execute()
+        if schedule:
+            current_app.task_queue.enqueue(self.job, retry=Retry(
+                max=retries, interval=[self.retry_interval * 2 ** i for i in range(retries)]))
+
+    def _acquire(self, token, wait):
+        deadline = time.monotonic() + wait
+        while not current_app.redis.set(self.lock_key, token, nx=True, ex=self.LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                raise FlushBusy(f'{self.lock_key} is held by another job')
+            time.sleep(0.1)
+
+    def _release(self, token):
+        with current_app.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.lock_key)
+                if pipe.get(self.lock_key) == token.encode():
+                    pipe.multi()
+                    pipe.delete(self.lock_key)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+    def drain(self, handle, batch_size, wait=30):
+        """
+        Pass the items to handle in batches until the list is empty. A
+        batch is only removed from the list once handle returned, so a
+        failed job leaves it to its retry.
+        :param handle: function called with a list of items
+        :raise FlushBusy: when another job held the lock for `wait` seconds
+        """
+        redis = current_app.redis
+        token = uuid.uuid4().hex
+        self._acquire(token, wait)
+        try:
+            while True:
+                batch = redis.lrange(self.key, 0, batch_size - 1)
+                if not batch:
+                    # a push between the read and the delete saw the flag
+                    # set and scheduled no job, so look again once cleared
+                    redis.delete(self.scheduled_key)
+                    if not redis.llen(self.key):
+                        return
+                    continue
+                handle([json.loads(raw) for raw in batch])
+                # pushes only append, so the head is still this batch
+                redis.ltrim(self.key, len(batch), -1)
+                redis.expire(self.lock_key, self.LOCK_TIMEOUT)
+        finally:
+            self._release(token)
@@ -0,0 +1,128 @@
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class _PoolStats(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.age_total = 0.0
+        self.age_max = 0.0
+
+
+class PoolMetrics(object):
+    """
+    Instrument the connection pools of the database engines: checkouts,
+    time spent waiting for a connection, overflow and age of the
+    connections handed out, to size the workers against the database.
+
+    Engines are only instrumented when METRICS_ENABLED is set.
+    """
+    # checkouts slower than this had to wait for a free or a new connection
+    WAIT_THRESHOLD = 0.001
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        stats = app.extensions['pool_metrics'] = {}
+        if not app.config.get('METRICS_ENABLED'):
+            return
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            engine = db.get_engine(app, bind=bind)
+            stats[bind or 'default'] = self._instrument(engine)
+
+    def _instrument(self, engine):
+        stats = _PoolStats(engine)
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            connection_record.info['connected_at'] = time.monotonic()
+            with stats.lock:
+                stats.connects += 1
+
+        @event.listens_for(engine, 'checkout')
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            age = time.monotonic() - connection_record.info.get(
+                'connected_at', time.monotonic())
+            with stats.lock:
+                stats.checkouts += 1
+                stats.age_total += age
+                stats.age_max = max(stats.age_max, age)
+
+        @event.listens_for(engine, 'checkin')
+        def checkin(dbapi_connection, connection_record):
+            with stats.lock:
+                stats.checkins += 1
+
+        self._time_checkouts(engine.pool, stats)
+
+        @event.listens_for(engine, 'engine_disposed')
+        def disposed(engine):
+            # dispose() swaps in a new pool, which needs timing again
+            self._time_checkouts(engine.pool, stats)
+
+        return stats
+
+    def _time_checkouts(self, pool, stats):
+        """
+        Time the checkouts of a pool. Pools have no event before a checkout,
+        so the wait is timed around Pool._do_get, the private method handing
+        out the connections. Without it the wait metrics stay at zero.
+        """
+        do_get = getattr(pool, '_do_get', None)
+        if do_get is None or getattr(do_get, 'timed', False):
+            return
+
+        def timed_do_get():
+            start = time.perf_counter()
+            try:
+                return do_get()
+            finally:
+                wait = time.perf_counter() - start
+                with stats.lock:
+                    stats.wait_total += wait
+                    stats.wait_max = max(stats.wait_max, wait)
+                    if wait > self.WAIT_THRESHOLD:
+                        stats.waits += 1
+
+        timed_do_get.timed = True
+        pool._do_get = timed_do_get
+
+    @staticmethod
+    def snapshot(app):
+        """
+        :return: dict of the pool metrics of every engine, by bind name
+        """
+        snapshot = {}
+        for name, stats in app.extensions['pool_metrics'].items():
+            pool = stats.engine.pool
+            with stats.lock:
+                metrics = {
+                    'pool': type(pool).__name__,
+                    'connects': stats.connects,
+                    'checkouts': stats.checkouts,
+                    'checkins': stats.checkins,
+                    'waits': stats.waits,
+                    'wait_seconds_total': stats.wait_total,
+                    'wait_seconds_max': stats.wait_max,
+                    'connection_age_seconds_avg':
+                        stats.age_total / stats.checkouts if stats.checkouts else 0.0,
+                    'connection_age_seconds_max': stats.age_max,
+                }
+            for gauge in ('size', 'checkedin', 'checkedout', 'overflow'):
+                if hasattr(pool, gauge):
+                    metrics[gauge] = getattr(pool, gauge)()
+            snapshot[name] = metrics
+        return snapshot
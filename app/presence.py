@@ -0,0 +1,81 @@
+import atexit
+import threading
+import time
+
+from flask import current_app
+
+
+class _State(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+
+class LastSeen(object):
+    """
+    Coalesce the last_seen updates of logged in users.
+
+    Every request only records the time in memory; the recorded times are
+    written to the database in one batched UPDATE at most once every
+    LAST_SEEN_FLUSH_INTERVAL seconds, instead of one commit per request.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 60)
+        app.extensions['last_seen'] = _State()
+        if not app.testing:
+            atexit.register(self._flush_at_exit, app)
+
+    @staticmethod
+    def _state(app=None):
+        return (app or current_app).extensions['last_seen']
+
+    def touch(self, user_id, when):
+        """
+        Record that the user was seen, flushing the pending times if the
+        flush interval has elapsed
+        """
+        state = self._state()
+        with state.lock:
+            state.pending[user_id] = when
+            due = time.monotonic() - state.last_flush >= \
+                current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if due:
+            self.flush()
+
+    def get(self, user_id):
+        """
+        :return: the not yet flushed last_seen time of the user, if any
+        """
+        return self._state().pending.get(user_id)
+
+    def flush(self):
+        """
+        Write all pending last_seen times in a single executemany UPDATE
+        """
+        from app import db
+        from app.main.models import User
+
+        state = self._state()
+        with state.lock:
+            pending, state.pending = state.pending, {}
+            state.last_flush = time.monotonic()
+        if not pending:
+            return
+
+        table = User.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                table.update().where(table.c.id == db.bindparam('user_id')).values(
+                    last_seen=db.bindparam('seen')),
+                [{'user_id': user_id, 'seen': seen} for user_id, seen in pending.items()])
+
+    def _flush_at_exit(self, app):
+        if not self._state(app).pending:
+            return
+        with app.app_context():
+            self.flush()
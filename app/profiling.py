@@ -0,0 +1,183 @@
+import os
+import random
+import time
+from datetime import datetime
+
+from flask import before_render_template, current_app, g, has_request_context, \
+    request, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+
+
+class _Profile(object):
+    def __init__(self, forced):
+        self.forced = forced
+        self.start = time.perf_counter()
+        self.queries = []
+        self.calls = []
+        self.template_stack = []
+        self.template_time = 0.0
+        self.profiler = None
+
+
+def current_profile():
+    """
+    :return: the profile of the current request, or None if it is not profiled
+    """
+    if not has_request_context():
+        return None
+    return g.get('_profile')
+
+
+class RequestProfiler(object):
+    """
+    Opt-in profiling of requests: the SQL statements with their timings,
+    the time spent rendering templates and calling external services.
+
+    Requests are profiled when PROFILING is set, or when an admin sends the
+    PROFILING_HEADER. Profiled requests slower than SLOW_REQUEST_THRESHOLD
+    and statements slower than SLOW_QUERY_THRESHOLD are logged, with their
+    details in the `fields` of the records; requests asked for by header
+    are always logged. A PROFILING_SAMPLE_RATE
+    fraction of the profiled requests also runs under cProfile, or
+    pyinstrument if installed and selected, with the dumps written to
+    PROFILING_DIR.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        app.config.setdefault('PROFILING', False)
+        app.config.setdefault('PROFILING_HEADER', 'X-Profile')
+        app.config.setdefault('SLOW_REQUEST_THRESHOLD', 0.5)
+        app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.1)
+        app.config.setdefault('PROFILING_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILING_ENGINE', 'cprofile')
+        app.config.setdefault('PROFILING_DIR', 'logs/profiles')
+
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._end_template, app)
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            engine = db.get_engine(app, bind=bind)
+            event.listen(engine, 'before_cursor_execute', self._start_query)
+            event.listen(engine, 'after_cursor_execute', self._end_query)
+
+    @staticmethod
+    def _requested_by_admin():
+        header = current_app.config['PROFILING_HEADER']
+        return bool(header and request.headers.get(header)) and \
+            current_user.is_authenticated and \
+            current_user.email in current_app.config['ADMINS']
+
+    def _start_request(self):
+        forced = self._requested_by_admin()
+        if not forced and not current_app.config['PROFILING']:
+            return
+        profile = g._profile = _Profile(forced)
+        if random.random() < current_app.config['PROFILING_SAMPLE_RATE']:
+            profile.profiler = self._start_profiler()
+
+    @staticmethod
+    def _start_profiler():
+        if current_app.config['PROFILING_ENGINE'] == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                current_app.logger.warning('pyinstrument is not installed, using cProfile')
+            else:
+                profiler = Profiler()
+                profiler.start()
+                return profiler
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _end_request(self, response):
+        profile = current_profile()
+        if profile is None:
+            return response
+        duration = time.perf_counter() - profile.start
+
+        config = current_app.config
+        for query in profile.queries:
+            if query['duration'] >= config['SLOW_QUERY_THRESHOLD']:
+                self._log('slow_query', query, endpoint=request.endpoint)
+        if profile.forced or duration >= config['SLOW_REQUEST_THRESHOLD']:
+            self._log('slow_request', {
+                'method': request.method,
+                'path': request.full_path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration': duration,
+                'query_count': len(profile.queries),
+                'query_time': sum(query['duration'] for query in profile.queries),
+                'template_time': profile.template_time,
+                'call_time': sum(call['duration'] for call in profile.calls),
+                'queries': profile.queries,
+                'calls': profile.calls,
+            })
+        return response
+
+    def _teardown_request(self, exc):
+        """
+        Stop the profiler, which runs on the thread of the request. This
+        also runs when the view raised, unlike after_request.
+        """
+        profile = g.pop('_profile', None)
+        if profile is not None and profile.profiler is not None:
+            self._dump(profile.profiler)
+
+    @staticmethod
+    def _log(event_name, record, **extra):
+        current_app.logger.warning(
+            '%s %s %.3fs', event_name, request.path, record['duration'],
+            extra={'fields': dict(event=event_name, **record, **extra)})
+
+    @staticmethod
+    def _dump(profiler):
+        directory = current_app.config['PROFILING_DIR']
+        os.makedirs(directory, exist_ok=True)
+        name = '{}-{}-{}'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+                                 request.endpoint or 'unmatched', os.getpid())
+        if hasattr(profiler, 'output_html'):
+            profiler.stop()
+            with open(os.path.join(directory, name + '.html'), 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(directory, name + '.prof'))
+
+    @staticmethod
+    def _start_template(sender, template, context, **extra):
+        profile = current_profile()
+        if profile is not None:
+            profile.template_stack.append(time.perf_counter())
+
+    @staticmethod
+    def _end_template(sender, template, context, **extra):
+        profile = current_profile()
+        if profile is not None and profile.template_stack:
+            start = profile.template_stack.pop()
+            # nested renders are part of the time of the outer template
+            if not profile.template_stack:
+                profile.template_time += time.perf_counter() - start
+
+    @staticmethod
+    def _start_query(conn, cursor, statement, parameters, context, executemany):
+        if current_profile() is not None:
+            conn.info['_profile_start'] = time.perf_counter()
+
+    @staticmethod
+    def _end_query(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('_profile_start', None)
+        profile = current_profile()
+        if start is not None and profile is not None:
+            profile.queries.append({'statement': statement[:1000],
+                                    'duration': time.perf_counter() - start})
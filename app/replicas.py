@@ -0,0 +1,75 @@
+import random
+import time
+
+from flask import g, has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the reads of GET and HEAD requests to a read replica,
+    chosen at random for each session, and everything else to the primary.
+
+    Reads stay on the primary for the rest of the session once it has
+    written, and for REPLICA_STICKY_SECONDS in the following requests of
+    the same client, so that users always read their own writes.
+
+    Clients without a cookie session cannot carry that window between
+    requests, so views serving them set g.primary_reads to read from the
+    primary only.
+    """
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def _reads_from_replica(self):
+        return self.app.extensions['sqlalchemy_replicas'] and \
+            not self.info.get('wrote') and \
+            has_request_context() and \
+            request.method in ('GET', 'HEAD') and \
+            not g.get('primary_reads') and \
+            flask_session.get('_primary_until', 0) < time.time()
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif self._reads_from_replica():
+            if 'replica' not in self.info:
+                self.info['replica'] = random.choice(
+                    self.app.extensions['sqlalchemy_replicas'])
+            return self.db.get_engine(self.app, bind=self.info['replica'])
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def commit(self):
+        super(RoutingSession, self).commit()
+        if self.info.get('wrote') and has_request_context() and \
+                self.app.extensions['sqlalchemy_replicas'] and not g.get('primary_reads'):
+            flask_session['_primary_until'] = \
+                time.time() + self.app.config['REPLICA_STICKY_SECONDS']
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self.info.pop('wrote', None)
+        self.info.pop('replica', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension registering the SQLALCHEMY_REPLICA_URIS as binds
+    and routing the session between them and the primary
+    """
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        replicas = []
+        for i, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS') or []):
+            binds[f'replica{i}'] = uri
+            replicas.append(f'replica{i}')
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        app.extensions['sqlalchemy_replicas'] = replicas
+        super(RoutingSQLAlchemy, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
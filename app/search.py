@@ -1,30 +1,296 @@
+import os
+
 from flask import current_app
+from redis.exceptions import RedisError
+
+from app import telemetry
+from app.pending import PendingList
+
+
+pending_operations = PendingList('search', 'app.tasks.flush_search_index', retry_interval=5)
+
+
+class BulkIndexError(Exception):
+    """
+    Raised when elasticsearch rejected some bulk operations with a
+    retryable status, so that the job is retried
+    """
+
+
+class SearchBackend(object):
+    """
+    Interface of the full-text engines behind the functions of this module.
+
+    Operations are the dicts built by index_operation and delete_operation.
+    Cursors are the lists of sort values returned by query_page.
+    """
+    # label of the engine in the call latency metrics
+    name = 'search'
+
+    def index(self, index, id, payload):
+        raise NotImplementedError
+
+    def delete(self, index, id):
+        raise NotImplementedError
+
+    def bulk(self, operations):
+        for operation in operations:
+            if operation['op'] == 'index':
+                self.index(operation['index'], operation['id'], operation['body'])
+            else:
+                self.delete(operation['index'], operation['id'])
+
+    def query(self, index, query, page, per_page):
+        """
+        :return: tuple(ids of the hits of the page, total number of hits)
+        """
+        raise NotImplementedError
+
+    def query_page(self, index, query, per_page, after=None, before=None):
+        """
+        :return: tuple(ids, sort values of each hit, whether more hits exist)
+        """
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(SearchBackend):
+    name = 'elasticsearch'
+
+    def __init__(self, client):
+        self.client = client
+
+    def index(self, index, id, payload):
+        self.client.index(index=index, id=id, body=payload)
+
+    def delete(self, index, id):
+        self.client.delete(index=index, id=id)
+
+    def bulk(self, operations):
+        """
+        Send all the operations in one _bulk request
+        :raise BulkIndexError: if some operations failed with a retryable status
+        """
+        body = []
+        for operation in operations:
+            action = {'_index': operation['index'], '_id': operation['id']}
+            if operation['op'] == 'index':
+                body.append({'index': action})
+                body.append(operation['body'])
+            else:
+                body.append({'delete': action})
+
+        response = self.client.bulk(body=body)
+        if not response['errors']:
+            return
+
+        retryable = []
+        for item in response['items']:
+            (op, result), = item.items()
+            status = result.get('status', 500)
+            if op == 'delete' and status == 404:
+                continue
+            if status == 429 or status >= 500:
+                retryable.append(result)
+            elif status >= 300:
+                current_app.logger.error('Search %s of %s/%s failed: %s', op,
+                                         result.get('_index'), result.get('_id'), result.get('error'))
+        if retryable:
+            raise BulkIndexError(f'{len(retryable)} bulk operations failed')
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def query_page(self, index, query, per_page, after=None, before=None):
+        """
+        Uses search_after, so that deep pages cost the same as the first one
+        and no total hit count is needed
+        """
+        order = 'asc' if before is not None else 'desc'
+        body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                'size': per_page + 1,
+                'track_total_hits': False,
+                'sort': [{'_score': order}, {'_id': 'desc' if before is not None else 'asc'}]}
+        if before is not None or after is not None:
+            body['search_after'] = before if before is not None else after
+
+        hits = self.client.search(index=index, body=body)['hits']['hits']
+        more = len(hits) > per_page
+        hits = hits[:per_page]
+        if before is not None:
+            hits.reverse()
+
+        return [int(hit['_id']) for hit in hits], [hit['sort'] for hit in hits], more
+
+
+def get_elasticsearch():
+    """
+    The elasticsearch client, created on first use so that the processes
+    which never search do not import it
+    :return: Elasticsearch or None when no cluster is configured
+    """
+    if 'elasticsearch' not in current_app.extensions:
+        config = current_app.config
+        client = None
+        if config['ELASTICSEARCH_URL'] or config['ELASTICSEARCH_CLOUD_ID']:
+            from elasticsearch import Elasticsearch
+
+            if config['ELASTICSEARCH_URL']:
+                client = Elasticsearch(config['ELASTICSEARCH_URL'])
+            else:
+                client = Elasticsearch(
+                    cloud_id=config['ELASTICSEARCH_CLOUD_ID'],
+                    basic_auth=(config['ELASTICSEARCH_USER'], config['ELASTICSEARCH_PASS']))
+        current_app.extensions['elasticsearch'] = client
+    return current_app.extensions['elasticsearch']
+
+
+def get_local_search():
+    """
+    The local full-text engine, opened on first use like the elasticsearch
+    client
+    :return: LocalSearchBackend or None when SEARCH_INDEX_PATH is empty
+    """
+    if 'local_search' not in current_app.extensions:
+        path = current_app.config['SEARCH_INDEX_PATH']
+        backend = None
+        if path:
+            from app.fulltext import LocalSearchBackend
+
+            if path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            backend = LocalSearchBackend(path)
+        current_app.extensions['local_search'] = backend
+    return current_app.extensions['local_search']
+
+
+def get_backend():
+    """
+    Elasticsearch when a cluster is configured, else the local engine if
+    one is enabled, else None
+    """
+    client = get_elasticsearch()
+    if client:
+        return ElasticsearchBackend(client)
+    return get_local_search()
 
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    backend = get_backend()
+    if not backend:
         return
 
+    with telemetry.timed(backend.name, 'index'):
+        backend.index(index, model.id, index_operation(index, model)['body'])
+
+
+def remove_from_index(index, model):
+    backend = get_backend()
+    if not backend:
+        return
+
+    with telemetry.timed(backend.name, 'delete'):
+        backend.delete(index, model.id)
+
+
+def index_operation(index, model):
+    """
+    Describe the indexing of a model as a json serializable operation
+    """
     payload = {}
     for value in model.__searchable__:
         payload[value] = getattr(model, value)
 
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    return {'op': 'index', 'index': index, 'id': model.id, 'body': payload}
 
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+def delete_operation(index, model):
+    return {'op': 'delete', 'index': index, 'id': model.id}
+
+
+def _latest_per_document(operations):
+    """
+    Keep only the last operation of each document, in order
+    """
+    latest = {}
+    for operation in operations:
+        key = (operation['index'], operation['id'])
+        latest.pop(key, None)
+        latest[key] = operation
+    return list(latest.values())
+
+
+def bulk_index(operations):
+    """
+    Apply index and delete operations in one batch
+    :raise BulkIndexError: if some operations failed with a retryable status
+    """
+    backend = get_backend()
+    if not backend or not operations:
+        return
+
+    with telemetry.timed(backend.name, 'bulk'):
+        backend.bulk(operations)
+
+
+def queue_index_operations(operations):
+    """
+    Hand index and delete operations over to the task queue which sends them
+    to elasticsearch in batches. Without a task queue, or with the local
+    engine, they are applied right away in a single batch.
+    """
+    if not operations:
+        return
+
+    if current_app.task_queue is None or not get_elasticsearch():
+        try:
+            bulk_index(_latest_per_document(operations))
+        except Exception:
+            current_app.logger.exception('Search indexing failed')
         return
 
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    try:
+        pending_operations.push(operations, current_app.config['SEARCH_BULK_RETRIES'])
+    except RedisError:
+        # the rows are committed already, a missing index update must not
+        # fail the request
+        current_app.logger.exception('Queueing search operations failed')
+
+
+def flush_pending_operations():
+    """
+    Drain the queued operations in batches of SEARCH_BULK_SIZE. A batch is
+    only removed from the queue once elasticsearch accepted it, so a failed
+    flush is picked up again by the retried job.
+    """
+    pending_operations.drain(lambda batch: bulk_index(_latest_per_document(batch)),
+                             current_app.config['SEARCH_BULK_SIZE'])
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    backend = get_backend()
+    if not backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+
+    with telemetry.timed(backend.name, 'query'):
+        return backend.query(index, query, page, per_page)
+
+
+def query_index_page(index, query, per_page, after=None, before=None):
+    """
+    Cursor based variant of query_index.
+
+    `after` and `before` are the sort values of the last, respectively first,
+    hit of the page the client is coming from.
+    :return: tuple(ids, sort values of each hit, whether more hits exist)
+    """
+    backend = get_backend()
+    if not backend:
+        return [], [], False
+
+    with telemetry.timed(backend.name, 'query'):
+        return backend.query_page(index, query, per_page, after=after, before=before)
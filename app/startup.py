@@ -0,0 +1,119 @@
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# dependencies only imported on first use, they must not be loaded by
+# create_app
+LAZY_MODULES = ('elasticsearch', 'langdetect', 'alembic')
+
+
+def _timed(function, name, timings):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.append((name, time.perf_counter() - start))
+    return wrapper
+
+
+def measure():
+    """
+    Create the application, timing every extension init_app and blueprint
+    registration, and print the timings as json. Meant to run in a fresh
+    interpreter started by profile_startup.
+    """
+    from flask import Flask
+    from werkzeug.local import LocalProxy
+
+    import app as package
+
+    extensions, blueprints = [], []
+    for name, value in vars(package).items():
+        if isinstance(value, (type, LocalProxy)):
+            continue
+        init_app = getattr(value, 'init_app', None)
+        if init_app is not None:
+            value.init_app = _timed(init_app, name, extensions)
+
+    register_blueprint = Flask.register_blueprint
+
+    def timed_register(app, blueprint, **options):
+        _timed(register_blueprint, blueprint.name, blueprints)(app, blueprint, **options)
+    Flask.register_blueprint = timed_register
+
+    start = time.perf_counter()
+    package.create_app()
+    json.dump({
+        'create_app': time.perf_counter() - start,
+        'extensions': extensions,
+        'blueprints': blueprints,
+        'lazy_modules_loaded': [name for name in LAZY_MODULES if name in sys.modules],
+    }, sys.stdout)
+
+
+def _parse_importtime(output):
+    """
+    Read the imports of a python -X importtime report
+    :return: list of tuple(module name, nesting depth, cumulative seconds),
+        in the order the imports completed
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(cumulative) / 1e6))
+    return imports
+
+
+def app_imports(imports):
+    """
+    Pick the imports made by the app package and by create_app, like the
+    blueprints, out of the result of _parse_importtime
+    :return: list of tuple(module name, cumulative seconds)
+    """
+    selected, children = [], []
+    for name, depth, seconds in imports:
+        if depth == 1:
+            children.append((name, seconds))
+        elif depth == 0:
+            # the children of a module are reported before it
+            if name == 'app':
+                selected.extend(children)
+            elif name.startswith('app.'):
+                selected.append((name, seconds))
+            children = []
+    return selected
+
+
+def profile_startup(environ=None):
+    """
+    Measure a cold start of the application in a fresh interpreter. It runs
+    in a temporary working directory, so that the files written by
+    create_app, like the logs, stay out of the checkout.
+    :param environ: environment of the interpreter instead of the current
+        one, which holds the configuration
+    :return: dict of the import times, the create_app time and the time
+        of every extension and blueprint, in seconds
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ if environ is None else environ, PYTHONPATH=root)
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        child = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import app; from app.startup import measure; measure()'],
+            cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(child.stdout)
+    report['process'] = time.perf_counter() - start
+    report['imports'] = _parse_importtime(child.stderr)
+    report['import_app'] = next(seconds for name, depth, seconds in report['imports']
+                                if name == 'app' and depth == 0)
+    return report
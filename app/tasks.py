@@ -0,0 +1,29 @@
+from app import create_app
+from app.email import flush_pending_email
+from app.language import preload_profiles, update_post_language
+from app.search import flush_pending_operations
+
+app = create_app()
+app.app_context().push()
+preload_profiles()
+
+
+def flush_search_index():
+    """
+    Send the queued search index operations to elasticsearch
+    """
+    flush_pending_operations()
+
+
+def detect_post_language(post_id):
+    """
+    Fill in the language of a newly created post
+    """
+    update_post_language(post_id)
+
+
+def send_queued_email():
+    """
+    Send the queued emails over one SMTP connection
+    """
+    flush_pending_email()
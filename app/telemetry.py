@@ -0,0 +1,231 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+from app.profiling import current_profile
+
+
+# seconds, from a cached page to a slow translation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Histogram(object):
+    """
+    Cumulative histogram in the Prometheus sense: the count of observations
+    less than or equal to each bucket bound, their sum and their count
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # one count per bucket, made cumulative when rendered
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _number(float(bound))
+                    lines.append(f'{self.name}_bucket{_labels(names, labels + (le,))} '
+                                 f'{cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} '
+                             f'{_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} '
+                             f'{cumulative}')
+        return lines
+
+
+class _Registry(object):
+    def __init__(self):
+        self.requests = Counter(
+            'microblog_http_requests_total', 'HTTP requests.',
+            ('endpoint', 'method', 'status'))
+        self.request_latency = Histogram(
+            'microblog_http_request_duration_seconds', 'Time spent handling HTTP requests.',
+            ('endpoint', 'method'))
+        self.request_queries = Histogram(
+            'microblog_db_queries_per_request', 'SQL statements run by HTTP requests.',
+            ('endpoint',), QUERY_COUNT_BUCKETS)
+        self.request_query_time = Histogram(
+            'microblog_db_query_duration_seconds_per_request',
+            'Time spent in SQL statements by HTTP requests.', ('endpoint',))
+        self.calls = Histogram(
+            'microblog_external_call_duration_seconds',
+            'Latency of the calls to the search engine and the translator.',
+            ('service', 'operation'))
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.request_latency, self.request_queries,
+                       self.request_query_time, self.calls):
+            lines.extend(metric.render())
+        return lines
+
+
+class Telemetry(object):
+    """
+    Per endpoint latency histograms, SQL statements per request and the
+    latency of the search engine and translator calls, rendered in the
+    Prometheus text format.
+
+    Nothing is recorded unless METRICS_ENABLED is set. Recording costs a
+    few dict updates per request and per SQL statement.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        if not app.config.get('METRICS_ENABLED'):
+            return
+        app.extensions['telemetry'] = _Registry()
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.teardown_request(self._teardown_request)
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            engine = db.get_engine(app, bind=bind)
+            event.listen(engine, 'before_cursor_execute', self._start_query)
+            event.listen(engine, 'after_cursor_execute', self._end_query)
+
+    @staticmethod
+    def _registry():
+        if not has_app_context():
+            return None
+        return current_app.extensions.get('telemetry')
+
+    @staticmethod
+    def _start_request():
+        g._telemetry = [time.perf_counter(), 0, 0.0]
+
+    @staticmethod
+    def _end_request(response):
+        g._telemetry_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        """
+        Record the request. This runs after unhandled exceptions too, unlike
+        after_request, and counts them as 500.
+        """
+        started = g.pop('_telemetry', None)
+        if started is None:
+            return
+        start, queries, query_time = started
+        status = 500 if exc is not None else g.pop('_telemetry_status', 500)
+        registry = self._registry()
+        endpoint = request.endpoint or 'unmatched'
+        registry.request_latency.observe(time.perf_counter() - start, endpoint, request.method)
+        registry.requests.inc(endpoint, request.method, str(status))
+        registry.request_queries.observe(queries, endpoint)
+        registry.request_query_time.observe(query_time, endpoint)
+
+    @staticmethod
+    def _start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info['_telemetry_start'] = time.perf_counter()
+
+    @staticmethod
+    def _end_query(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('_telemetry_start', None)
+        if start is not None and has_request_context() and '_telemetry' in g:
+            g._telemetry[1] += 1
+            g._telemetry[2] += time.perf_counter() - start
+
+    @contextmanager
+    def timed(self, service, operation):
+        """
+        Record the latency of the call to an external service made in the
+        with block, in the metrics and in the profile of the request
+        """
+        registry = self._registry()
+        profile = current_profile()
+        if registry is None and profile is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if registry is not None:
+                registry.calls.observe(duration, service, operation)
+            if profile is not None:
+                profile.calls.append({'service': service, 'operation': operation,
+                                      'duration': duration})
+
+    def render(self, app):
+        """
+        :return: the metrics of the app, and those of its connection pools,
+            in the Prometheus text exposition format
+        """
+        from app import pool_metrics
+
+        lines = app.extensions['telemetry'].render()
+        pools = pool_metrics.snapshot(app)
+        gauges = sorted({name for metrics in pools.values() for name, value in metrics.items()
+                         if not isinstance(value, str)})
+        for gauge in gauges:
+            name = f'microblog_db_pool_{gauge}'
+            lines += [f'# HELP {name} Connection pool {gauge.replace("_", " ")}.',
+                      f'# TYPE {name} gauge']
+            for bind, metrics in sorted(pools.items()):
+                if gauge in metrics:
+                    lines.append(f'{name}{_labels(("bind",), (bind,))} '
+                                 f'{_number(metrics[gauge])}')
+        return '\n'.join(lines) + '\n'
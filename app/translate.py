@@ -1,19 +1,75 @@
-import json
+from hashlib import sha1
+
 import requests
 from flask_babel import _
 from flask import current_app
 
+from app import telemetry
+from app.cache import LRUCache, RedisCache, TieredCache
+from app.http import http_session
+
+
+def _cache():
+    cache = current_app.extensions.get('translation_cache')
+    if cache is None:
+        ttl = current_app.config['TRANSLATION_CACHE_TTL']
+        shared = None
+        if current_app.redis is not None:
+            shared = RedisCache(current_app.redis, 'translation:', ttl)
+        cache = TieredCache(LRUCache(current_app.config['TRANSLATION_CACHE_SIZE'], ttl), shared)
+        current_app.extensions['translation_cache'] = cache
+    return cache
+
+
+def _cache_key(text, source_language, dest_language):
+    digest = sha1(text.encode('utf-8')).hexdigest()
+    return f'{digest}:{source_language}:{dest_language}'
+
+
 def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in app.config or \
+    translations = translate_batch([text], source_language, dest_language)
+    if isinstance(translations, str):
+        return translations
+    return translations[0]
+
+
+def translate_batch(texts, source_language, dest_language):
+    """
+    Translate several texts of the same language with at most one call to
+    the translator API; cached translations are not requested again.
+    :return: list of translations in the order of texts, or an error message
+    """
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
             not current_app.config['MS_TRANSLATOR_KEY']:
         return _('Error: the translation service is not configured.')
+
+    cache = _cache()
+    keys = [_cache_key(text, source_language, dest_language) for text in texts]
+    translations = [cache.get(key) for key in keys]
+    missing = sorted({text for text, translation in zip(texts, translations)
+                      if translation is None})
+    if not missing:
+        return translations
+
     auth = {
-        'Ocp-Apim-Subscription-Key': app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus2'}
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[{'Text': text}])
+        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
+        'Ocp-Apim-Subscription-Region': current_app.config['MS_TRANSLATOR_REGION']}
+    try:
+        with telemetry.timed('translator', 'translate'):
+            r = http_session().post(
+                current_app.config['MS_TRANSLATOR_URL'] +
+                '/translate?api-version=3.0&from={}&to={}'.format(
+                    source_language, dest_language),
+                headers=auth, json=[{'Text': text} for text in missing], timeout=10)
+    except requests.RequestException:
+        return _('Error: the translation service failed.')
     if r.status_code != 200:
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+
+    fetched = {}
+    for text, result in zip(missing, r.json()):
+        fetched[text] = result['translations'][0]['text']
+        cache.set(_cache_key(text, source_language, dest_language), fetched[text])
+
+    return [translation if translation is not None else fetched[text]
+            for text, translation in zip(texts, translations)]
@@ -0,0 +1,340 @@
+"""
+Latency, throughput and query counts of the core user flows on a seeded
+dataset, through the test client and through a pre-forked WSGI server.
+
+    python benchmarks/core_flows.py --users 2000 --posts 20000 --output run.json
+    python benchmarks/core_flows.py --users 2000 --posts 20000 --compare run.json
+
+The dataset is generated from a fixed seed, so runs with the same arguments
+on different commits measure the same work. With --compare the run fails
+when the p95 latency of a route grew beyond --tolerance, or when a route
+runs more queries than in the baseline.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+import sqlalchemy  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.main.models import User, Post  # noqa: E402
+from config import Config  # noqa: E402
+
+WORDS = ('morning coffee weather rain football match music concert travel train '
+         'book reading garden flowers market dinner friends family holiday beach '
+         'mountain river city night movie series code python flask database').split()
+PASSWORD = 'benchmark'
+
+
+def bench_config(directory):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+        SEARCH_INDEX_PATH = os.path.join(directory, 'search.db')
+        REDIS_URL = None
+        WTF_CSRF_ENABLED = False
+        TESTING = True
+
+    return BenchConfig
+
+
+def seed(users, posts, mean_follows, seed_value):
+    """
+    Users following others with a power-law popularity: the user of rank r
+    is picked as followee, and as author, with a weight of 1 / (r + 1) ** 1.2,
+    and out-degrees follow a Pareto distribution of the given mean
+    """
+    rng = random.Random(seed_value)
+    people = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(users)]
+    people[0].set_password(PASSWORD)
+    db.session.add_all(people)
+    db.session.commit()
+
+    weights = [1 / (rank + 1) ** 1.2 for rank in range(users)]
+    for i, user in enumerate(people):
+        # a Pareto variate of shape 1.5 has a mean of 3
+        count = min(users - 1, int(rng.paretovariate(1.5) * mean_follows / 3))
+        for followed in set(rng.choices(people, weights, k=count)):
+            if followed is not user:
+                user.follow(followed)
+        if i % 200 == 199:
+            db.session.commit()
+    db.session.commit()
+
+    start = datetime(2021, 1, 1)
+    for i in range(posts):
+        post = Post(body=' '.join(rng.sample(WORDS, 8)), language='en',
+                    author=rng.choices(people, weights)[0],
+                    timestamp=start + timedelta(minutes=i))
+        db.session.add(post)
+        db.session.flush()
+        post.fan_out()
+        if i % 500 == 499:
+            db.session.commit()
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+
+def flows(users):
+    """
+    The measured routes, as functions of a client-like object and the index
+    of the request. The reader is user0, the most followed user.
+    """
+    def follow(client, i):
+        # follow and unfollow in turn a user the reader does not follow
+        target = f'user{users - 1 - i // 2 % 10}'
+        action = 'follow' if i % 2 == 0 else 'unfollow'
+        return client.post(f'/{action}/{target}')
+
+    return {
+        'index': lambda client, i: client.get('/index'),
+        'explore': lambda client, i: client.get('/explore'),
+        'profile': lambda client, i: client.get(f'/user/user{i % 20}'),
+        'search': lambda client, i: client.get(f'/search?q={WORDS[i % len(WORDS)]}'),
+        'follow': follow,
+    }
+
+
+def percentile(timings, p):
+    ordered = sorted(timings)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summary(timings, elapsed, errors=0):
+    return {'requests': len(timings), 'errors': errors,
+            'p50_ms': percentile(timings, 50), 'p95_ms': percentile(timings, 95),
+            'p99_ms': percentile(timings, 99), 'mean_ms': statistics.mean(timings),
+            'throughput_rps': len(timings) / elapsed}
+
+
+def run_test_client(app, routes, count):
+    """
+    Run each route `count` times in a row, in process, counting the SQL
+    statements of every request
+    """
+    results = {}
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'user0', 'password': PASSWORD})
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        for name, flow in routes.items():
+            timings, queries, errors = [], [], 0
+            started = time.perf_counter()
+            for i in range(count):
+                del statements[:]
+                start = time.perf_counter()
+                response = flow(client, i)
+                timings.append((time.perf_counter() - start) * 1000)
+                queries.append(len(statements))
+                errors += response.status_code >= 400
+            results[name] = summary(timings, time.perf_counter() - started, errors)
+            results[name]['queries'] = max(queries)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return results
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log(self, type, message, *args):
+        pass
+
+
+def _serve(config, fd):
+    app = create_app(config)
+    make_server('127.0.0.1', 0, app, request_handler=_QuietHandler, fd=fd).serve_forever()
+
+
+def start_workers(config, workers):
+    """
+    Pre-fork `workers` single threaded WSGI servers accepting on one socket
+    :return: tuple(url, worker processes)
+    """
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_serve, args=(config, listener.fileno()), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    url = 'http://127.0.0.1:%d' % listener.getsockname()[1]
+    listener.close()
+
+    for _ in range(100):
+        try:
+            requests.get(url + '/auth/login', timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    return url, processes
+
+
+class _HTTPClient(object):
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        self.session.post(url + '/auth/login',
+                          data={'username': 'user0', 'password': PASSWORD})
+
+    def get(self, path):
+        return self.session.get(self.url + path, allow_redirects=False)
+
+    def post(self, path):
+        return self.session.post(self.url + path, allow_redirects=False)
+
+
+def run_load(url, routes, count, concurrency):
+    """
+    Send `count` requests per route from `concurrency` client threads, each
+    thread going through the routes in turn
+    """
+    local = threading.local()
+    plan = [(name, i) for i in range(count) for name in routes]
+
+    def send(job):
+        name, i = job
+        if not hasattr(local, 'client'):
+            local.client = _HTTPClient(url)
+        start = time.perf_counter()
+        response = routes[name](local.client, i)
+        return name, (time.perf_counter() - start) * 1000, response.status_code >= 400
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        done = list(executor.map(send, plan))
+    elapsed = time.perf_counter() - started
+
+    results = {}
+    for name in routes:
+        timings = [timing for route, timing, _ in done if route == name]
+        errors = sum(error for route, _, error in done if route == name)
+        results[name] = summary(timings, elapsed, errors)
+        # throughput of the route within the mix
+        results[name]['throughput_rps'] = len(timings) / elapsed
+    results['all'] = summary([timing for _, timing, _ in done], elapsed,
+                             sum(error for _, _, error in done))
+    return results
+
+
+def print_results(title, results):
+    print(title)
+    print(f'  {"route":<10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}'
+          f'{"queries":>9}{"errors":>8}')
+    for name, row in results.items():
+        print(f'  {name:<10}{row["p50_ms"]:>10.2f}{row["p95_ms"]:>10.2f}{row["p99_ms"]:>10.2f}'
+              f'{row["throughput_rps"]:>10.1f}{row.get("queries", ""):>9}{row["errors"]:>8}')
+
+
+def compare(baseline, current, tolerance):
+    """
+    :return: the list of regressions of current against the baseline
+    """
+    regressions = []
+    print(f'against the baseline of {baseline["meta"]["commit"]}')
+    for mode in ('test_client', 'wsgi'):
+        for name, row in current.get(mode, {}).items():
+            before = baseline.get(mode, {}).get(name)
+            if before is None:
+                continue
+            change = row['p95_ms'] / before['p95_ms'] - 1
+            print(f'  {mode:<12}{name:<10} p95 {before["p95_ms"]:9.2f}ms -> '
+                  f'{row["p95_ms"]:9.2f}ms ({change:+.0%})')
+            if change > tolerance:
+                regressions.append(f'{mode} {name}: p95 {change:+.0%}')
+            if row.get('queries', 0) > before.get('queries', row.get('queries', 0)):
+                regressions.append(f'{mode} {name}: {before["queries"]} -> '
+                                   f'{row["queries"]} queries')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20, help='mean follows per user')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-wsgi', action='store_true')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='json results of a baseline run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 increase over the baseline, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    config = bench_config(directory)
+    app = create_app(config)
+    routes = flows(args.users)
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        seed(args.users, args.posts, args.follows, args.seed)
+        print(f'seeded {args.users} users and {args.posts} posts '
+              f'in {time.perf_counter() - start:.1f}s')
+        results = {'test_client': run_test_client(app, routes, args.requests)}
+        db.session.remove()
+    print_results('test client', results['test_client'])
+
+    if not args.skip_wsgi:
+        url, processes = start_workers(config, args.workers)
+        try:
+            results['wsgi'] = run_load(url, routes, args.requests, args.concurrency)
+        finally:
+            for process in processes:
+                process.terminate()
+        print_results(f'wsgi, {args.workers} workers, {args.concurrency} clients',
+                      results['wsgi'])
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                            text=True, cwd=os.path.dirname(__file__)).stdout.strip() or 'unknown'
+    results['meta'] = {
+        'commit': commit,
+        'date': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'arguments': {key: value for key, value in vars(args).items()
+                      if key not in ('output', 'compare', 'tolerance', 'skip_wsgi')},
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta']['arguments'] != results['meta']['arguments']:
+            print('warning: the baseline ran with other arguments')
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print('regressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
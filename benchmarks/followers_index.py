@@ -0,0 +1,128 @@
+"""
+Query plans and latency of the timeline queries on a large follow graph,
+with and without the followers primary key and the post indexes.
+
+    python benchmarks/followers_index.py --users 10000 --edges 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+from app.main.models import User, Post, followers  # noqa: E402
+from config import Config  # noqa: E402
+
+
+def seed(users, edges, posts, chunk=50000):
+    rng = random.Random(42)
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com'}
+        for i in range(1, users + 1)])
+
+    seen = set()
+    while len(seen) < edges:
+        follower, followed = rng.randint(1, users), rng.randint(1, users)
+        if follower != followed:
+            seen.add((follower, followed))
+    edges = [{'follower_id': a, 'followed_id': b} for a, b in seen]
+    for start in range(0, len(edges), chunk):
+        db.session.execute(followers.insert(), edges[start:start + chunk])
+
+    now = datetime.utcnow()
+    rows = [{'body': f'post {i}', 'user_id': rng.randint(1, users),
+             'timestamp': now - timedelta(seconds=i)} for i in range(posts)]
+    for start in range(0, len(rows), chunk):
+        db.session.execute(Post.__table__.insert(), rows[start:start + chunk])
+    db.session.commit()
+
+
+def drop_indexes():
+    """
+    Go back to the original schema: a followers heap without any key and
+    no (user_id, timestamp) index on post
+    """
+    for statement in (
+            'CREATE TABLE followers_heap (follower_id INTEGER, followed_id INTEGER)',
+            'INSERT INTO followers_heap SELECT follower_id, followed_id FROM followers',
+            'DROP TABLE followers',
+            'ALTER TABLE followers_heap RENAME TO followers',
+            'DROP INDEX ix_post_user_id_timestamp',
+            'ANALYZE'):
+        db.session.execute(db.text(statement))
+    db.session.commit()
+
+
+def explain(query):
+    statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    return [row[-1] for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {statement}'))]
+
+
+def timed(label, samples, func):
+    timings = []
+    for sample in samples:
+        start = time.perf_counter()
+        func(sample)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f'  {label:<28} p50 {statistics.median(timings):9.2f}ms   '
+          f'p95 {timings[int(len(timings) * 0.95) - 1]:9.2f}ms')
+
+
+def report(title, readers, per_page):
+    print(title)
+    reader = readers[0]
+    for line in explain(reader.followed_posts().limit(per_page)):
+        print(f'    plan: {line}')
+
+    timed('followed_posts first page', readers,
+          lambda user: user.followed_posts().limit(per_page).all())
+    timed('is_following', readers,
+          lambda user: user.is_following(readers[-1]))
+    timed('profile first page', readers,
+          lambda user: Post.query.filter_by(user_id=user.id).order_by(
+              Post.timestamp.desc()).limit(per_page).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'app.db')
+        SEARCH_INDEX_PATH = ''
+        REDIS_URL = None
+        TESTING = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        seed(args.users, args.edges, args.posts)
+        print(f'seeded {args.users} users, {args.edges} edges and {args.posts} posts '
+              f'in {time.perf_counter() - start:.1f}s')
+        db.session.execute(db.text('ANALYZE'))
+
+        rng = random.Random(7)
+        readers = User.query.filter(User.id.in_(
+            rng.sample(range(1, args.users + 1), args.samples))).all()
+        per_page = app.config['POST_PER_PAGE']
+
+        report('with the followers primary key and post (user_id, timestamp) index',
+               readers, per_page)
+        drop_indexes()
+        report('without them', readers, per_page)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Login throughput, and latency of the other routes, during a login burst
+with an unbounded and a bounded password hashing pool.
+
+    python benchmarks/login_burst.py --clients 32 --seconds 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.main.models import User, Post  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log(self, type, message, *args):
+        pass
+
+
+def run(label, workers, queue, args):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'app.db')
+        SEARCH_INDEX_PATH = ''
+        REDIS_URL = None
+        WTF_CSRF_ENABLED = False
+        RESPONSE_CACHE = False
+        TESTING = True
+        PASSWORD_HASH_METHOD = f'pbkdf2:sha256:{args.iterations}'
+        PASSWORD_HASH_WORKERS = workers
+        PASSWORD_HASH_QUEUE = queue
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        user.set_password('cat')
+        db.session.add_all([user] + [Post(body=f'post {i}', author=user) for i in range(20)])
+        db.session.commit()
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    deadline = time.perf_counter() + args.seconds
+    outcomes = {'ok': 0, 'rejected': 0}
+    lock = threading.Lock()
+
+    def login_loop():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            response = session.post(url + '/auth/login', allow_redirects=False,
+                                    data={'username': 'john', 'password': 'cat'})
+            session.cookies.clear()
+            with lock:
+                outcomes['ok' if response.status_code == 302 else 'rejected'] += 1
+
+    timings = []
+
+    def explore_loop():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            session.get(url + '/explore')
+            timings.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=login_loop) for _ in range(args.clients)]
+    threads.append(threading.Thread(target=explore_loop))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    timings.sort()
+    print(f'{label:<34} logins {outcomes["ok"] / args.seconds:7.1f}/s   '
+          f'rejected {outcomes["rejected"] / args.seconds:7.1f}/s   '
+          f'/explore p50 {statistics.median(timings):7.1f}ms   '
+          f'p95 {timings[int(len(timings) * 0.95) - 1]:7.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--iterations', type=int, default=260000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--queue', type=int, default=16)
+    args = parser.parse_args()
+
+    # as many hashing threads as login clients is hashing on the request threads
+    run('unbounded', args.clients, args.clients, args)
+    run(f'{args.workers} workers, queue of {args.queue}', args.workers, args.queue, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Render time of index.html with and without the post fragment cache.
+
+    python benchmarks/post_fragments.py --repeat 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import g, render_template  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.main.models import User, Post  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_INDEX_PATH = ':memory:'
+    REDIS_URL = None
+    TESTING = True
+
+
+def seed(count):
+    users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(20)]
+    now = datetime.utcnow()
+    posts = [Post(body=f'post number {i} ' * 5, author=users[i % len(users)],
+                  language='ha' if i % 3 else 'en', timestamp=now - timedelta(minutes=i))
+             for i in range(count)]
+    db.session.add_all(users + posts)
+    db.session.commit()
+    return posts
+
+
+def render_time(app, posts, repeat):
+    timings = []
+    for _ in range(repeat):
+        with app.test_request_context('/explore'):
+            g.locale = 'en'
+            start = time.perf_counter()
+            render_template('index.html', title='Home', posts=posts,
+                            next_url=None, prev_url=None)
+            timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        all_posts = seed(100)
+        print(f'{"posts":>5} {"cache off":>12} {"cache on":>12} {"speedup":>8}')
+        for count in (10, 50, 100):
+            posts = all_posts[:count]
+            app.config['POST_FRAGMENT_CACHE'] = False
+            off = render_time(app, posts, args.repeat)
+            app.config['POST_FRAGMENT_CACHE'] = True
+            render_time(app, posts, 1)
+            on = render_time(app, posts, args.repeat)
+            print(f'{count:>5} {off:>10.2f}ms {on:>10.2f}ms {off / on:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
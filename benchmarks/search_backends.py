@@ -0,0 +1,164 @@
+"""
+Compare the local SQLite FTS5 search engine with the elasticsearch path.
+
+The elasticsearch path runs the real client against a small in-process
+HTTP stand-in that understands _bulk and _search, so the numbers include
+the client, HTTP and JSON costs of that path but not the work of a real
+cluster.
+
+    python benchmarks/search_backends.py --posts 20000 --queries 500
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elasticsearch import Elasticsearch  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.main.models import User, Post  # noqa: E402
+from config import Config  # noqa: E402
+
+WORDS = ('time person year way day thing man world life hand part child eye '
+         'woman place work week case point government company number group '
+         'problem fact good new first last long great little own other old '
+         'right big high different small large next early young important').split()
+
+
+class StandInElasticsearch(BaseHTTPRequestHandler):
+    """
+    Just enough of the elasticsearch REST API for the bulk and search calls
+    of app/search.py, backed by a naive in-memory term index
+    """
+    documents = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8')
+
+    def _reply(self, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.split('?')[0].endswith('/_bulk'):
+            return self._bulk()
+        return self._search()
+
+    do_GET = do_POST
+
+    def _bulk(self):
+        lines = [json.loads(line) for line in self._body().splitlines() if line]
+        items = []
+        while lines:
+            (op, meta), = lines.pop(0).items()
+            key = (meta['_index'], str(meta['_id']))
+            if op == 'index':
+                body = lines.pop(0)
+                self.documents[key] = set(re.findall(r'\w+', ' '.join(
+                    str(value).lower() for value in body.values())))
+            else:
+                self.documents.pop(key, None)
+            items.append({op: {'_index': key[0], '_id': key[1], 'status': 200}})
+        self._reply({'errors': False, 'items': items})
+
+    def _search(self):
+        index = self.path.lstrip('/').split('/')[0]
+        body = json.loads(self._body())
+        terms = set(re.findall(r'\w+', body['query']['multi_match']['query'].lower()))
+        hits = sorted(
+            ((float(len(terms & words)), doc_id)
+             for (doc_index, doc_id), words in self.documents.items()
+             if doc_index == index and terms & words),
+            key=lambda hit: (-hit[0], hit[1]))
+        if 'search_after' in body:
+            score, doc_id = body['search_after']
+            hits = [hit for hit in hits if (-hit[0], hit[1]) > (-score, doc_id)]
+        start = body.get('from', 0)
+        page = hits[start:start + body.get('size', 10)]
+        self._reply({'hits': {
+            'total': {'value': len(hits), 'relation': 'eq'},
+            'hits': [{'_id': doc_id, '_score': score, 'sort': [score, doc_id]}
+                     for score, doc_id in page]}})
+
+
+def seed(posts):
+    rng = random.Random(42)
+    users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(100)]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.bulk_insert_mappings(Post, [
+        {'body': ' '.join(rng.choices(WORDS, k=12)), 'user_id': rng.choice(users).id}
+        for _ in range(posts)])
+    db.session.commit()
+
+
+def measure(label, queries, per_page):
+    rng = random.Random(7)
+    start = time.perf_counter()
+    Post.reindex()
+    indexing = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(queries):
+        expression = ' '.join(rng.choices(WORDS, k=2))
+        start = time.perf_counter()
+        page = Post.search_page(expression, per_page)
+        page.items and page.items[0].author
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    print(f'{label:<16} index {indexing:8.2f}s   '
+          f'p50 {statistics.median(latencies):7.2f}ms   '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1]:7.2f}ms   '
+          f'p99 {latencies[int(len(latencies) * 0.99) - 1]:7.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--per-page', type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'app.db')
+        SEARCH_INDEX_PATH = os.path.join(workdir, 'search.db')
+        REDIS_URL = None
+        TESTING = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        seed(args.posts)
+
+        app.extensions['elasticsearch'] = None
+        measure('local fts5', args.queries, args.per_page)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInElasticsearch)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        app.extensions['elasticsearch'] = Elasticsearch(f'http://127.0.0.1:{server.server_port}')
+        measure('elasticsearch', args.queries, args.per_page)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
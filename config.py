@@ -12,16 +12,92 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URI") or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URIS = [
+        uri.strip() for uri in
+        (os.environ.get('DATABASE_REPLICA_URIS') or '').split(',') if uri.strip()]
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
+    # connection pool of the database engines; only the options set are
+    # passed on, as SQLite engines do not accept all of them
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        option: cast(os.environ[name]) for option, name, cast in [
+            ('pool_size', 'DATABASE_POOL_SIZE', int),
+            ('max_overflow', 'DATABASE_MAX_OVERFLOW', int),
+            ('pool_timeout', 'DATABASE_POOL_TIMEOUT', float),
+            ('pool_recycle', 'DATABASE_POOL_RECYCLE', int),
+            ('pool_pre_ping', 'DATABASE_POOL_PRE_PING', lambda value: value != '0'),
+        ] if os.environ.get(name)}
+    # stored hashes made with another method are upgraded at login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    # hashing threads, and hashes waiting for one before logins are rejected
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    PASSWORD_HASH_TIMEOUT = int(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS')
     ADMINS = ['abbaraees@gmail.com']
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 100)
+    MAIL_SEND_RETRIES = int(os.environ.get('MAIL_SEND_RETRIES') or 3)
+    # batches waiting for the mail thread when there is no task queue
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+    # the same error is mailed once per period, and a few mails per minute at most
+    ERROR_MAIL_DEDUPE_SECONDS = int(os.environ.get('ERROR_MAIL_DEDUPE_SECONDS') or 600)
+    ERROR_MAIL_PER_MINUTE = int(os.environ.get('ERROR_MAIL_PER_MINUTE') or 10)
     POST_PER_PAGE = 10
+    API_MAX_PER_PAGE = int(os.environ.get('API_MAX_PER_PAGE') or 100)
+    # api responses smaller than this are not worth compressing
+    API_GZIP_MIN_SIZE = int(os.environ.get('API_GZIP_MIN_SIZE') or 500)
+    RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', '1') != '0'
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE') or 1000)
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL') or 30)
+    POST_FRAGMENT_CACHE = os.environ.get('POST_FRAGMENT_CACHE', '1') != '0'
+    POST_FRAGMENT_CACHE_SIZE = int(os.environ.get('POST_FRAGMENT_CACHE_SIZE') or 5000)
+    POST_FRAGMENT_CACHE_TTL = int(os.environ.get('POST_FRAGMENT_CACHE_TTL') or 3600)
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 200)
     LANGUAGES = ['en', 'ha']
+    # server-sent events of new posts on the home page
+    LIVE_MAX_CONNECTIONS = int(os.environ.get('LIVE_MAX_CONNECTIONS') or 1000)
+    LIVE_HEARTBEAT_SECONDS = int(os.environ.get('LIVE_HEARTBEAT_SECONDS') or 15)
+    LIVE_MAX_SECONDS = int(os.environ.get('LIVE_MAX_SECONDS') or 300)
+    # serve avatars from this app, caching the gravatar images locally
+    AVATAR_PROXY = bool(os.environ.get('AVATAR_PROXY'))
+    AVATAR_CACHE_SIZE = int(os.environ.get('AVATAR_CACHE_SIZE') or 2048)
+    AVATAR_CACHE_TTL = int(os.environ.get('AVATAR_CACHE_TTL') or 24 * 3600)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
     MS_TRANSLATOR_KEY = os.environ.get("MS_TRANSLATOR_KEY")
+    MS_TRANSLATOR_URL = os.environ.get("MS_TRANSLATOR_URL") or \
+        'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_REGION = os.environ.get("MS_TRANSLATOR_REGION") or 'westus2'
+    TRANSLATION_CACHE_SIZE = int(os.environ.get("TRANSLATION_CACHE_SIZE") or 4096)
+    TRANSLATION_CACHE_TTL = int(os.environ.get("TRANSLATION_CACHE_TTL") or 7 * 24 * 3600)
+    TRANSLATION_BATCH_LIMIT = 100
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
     ELASTICSEARCH_CLOUD_ID = os.environ.get("ELASTICSEARCH_CLOUD_ID")
-    ELASTICSEARCH_USER = os.environ.get("ELASTICSEARCH_USER_")
+    ELASTICSEARCH_USER = os.environ.get("ELASTICSEARCH_USER")
     ELASTICSEARCH_PASS = os.environ.get("ELASTICSEARCH_PASS")
+    # full-text index used when no elasticsearch cluster is configured,
+    # set to an empty string to disable search in that case
+    SEARCH_INDEX_PATH = os.environ.get("SEARCH_INDEX_PATH",
+                                       os.path.join(basedir, 'instance', 'search.db'))
+    SEARCH_BULK_SIZE = int(os.environ.get("SEARCH_BULK_SIZE") or 500)
+    SEARCH_BULK_RETRIES = int(os.environ.get("SEARCH_BULK_RETRIES") or 5)
+    REDIS_URL = os.environ.get("REDIS_URL")
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    # fraction of the requests written to the access log, server errors always are
+    ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE') or 0.01)
+    # internal metrics endpoints under /metrics
+    METRICS_ENABLED = bool(os.environ.get('METRICS_ENABLED'))
+    # profile every request, or only those of admins sending PROFILING_HEADER
+    PROFILING = bool(os.environ.get('PROFILING'))
+    PROFILING_HEADER = 'X-Profile'
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 0.5)
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 0.1)
+    # fraction of the profiled requests dumped by cProfile or pyinstrument
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE') or 0)
+    PROFILING_ENGINE = os.environ.get('PROFILING_ENGINE') or 'cprofile'
+    PROFILING_DIR = os.path.join(basedir, 'logs', 'profiles')
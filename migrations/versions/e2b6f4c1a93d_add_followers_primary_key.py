@@ -0,0 +1,61 @@
+"""add followers primary key and timeline indexes
+
+Revision ID: e2b6f4c1a93d
+Revises: c47a9d3e8b05
+Create Date: 2026-10-18 14:21:09.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b6f4c1a93d'
+down_revision = 'c47a9d3e8b05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # rebuild followers with a composite primary key, dropping the
+    # duplicate edges that the old table allowed
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute(
+        'INSERT INTO followers_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+
+    # duplicate edges were counted twice
+    op.execute(
+        'UPDATE "user" SET '
+        'follower_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'followed_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute(
+        'INSERT INTO followers_old (follower_id, followed_id) '
+        'SELECT follower_id, followed_id FROM followers'
+    )
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
+    op.create_index('ix_followers_follower_id_followed_id', 'followers', ['follower_id', 'followed_id'], unique=False)
@@ -1,15 +1,189 @@
+import base64
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from hashlib import md5
+from html import unescape as html_unescape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import json
+import logging
+from logging.handlers import QueueHandler
+import os
+import re
+import socketserver
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
+from unittest import mock
+
+from flask.logging import default_handler
+from redis import Redis
+from sqlalchemy import event
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from app import create_app, db, last_seen, request_logging
+from app.cli import register as register_commands
+from app.main.caching import invalidate, tag_version
 from app.main.models import User, Post
+from app.main.pagination import KeysetPagination, decode_cursor, decode_post_cursor, encode_cursor
+from app.auth.email import send_reset_password_email
+from app.email import (
+    FAILED_KEY, ErrorMailHandler, _background_sender, flush_pending_email, pending_messages,
+    queue_email
+)
+from app.language import backfill_languages
+from app.search import (
+    flush_pending_operations, get_local_search, index_operation, pending_operations,
+    queue_index_operations
+)
+from app.live import RedisBroker
+from app.log import JSONFormatter
+from app.passwords import HashingBusy
+from app.pool import PoolMetrics
+from app.pending import FlushBusy
+from app.startup import profile_startup
+from app.translate import translate, translate_batch
 from config import Config
 
 
 class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_INDEX_PATH = ':memory:'
     TESTING = True
 
 
+class QueryCountMixin(object):
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        """
+        Fail if the code in the with block runs more than `limit` SQL statements
+        """
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertLessEqual(
+            len(statements), limit,
+            f"{len(statements)} queries executed, expected at most {limit}:\n" +
+            "\n".join(statements))
+
+
+class FakeElasticsearch(object):
+    """
+    Records the bulk requests instead of sending them
+    """
+    def __init__(self):
+        self.bulk_requests = []
+
+    def bulk(self, body):
+        self.bulk_requests.append(body)
+        return {'errors': False, 'items': []}
+
+
+class StubTranslator(object):
+    """
+    Local stand-in for the Microsoft Translator API that upper cases the
+    texts and records every request it receives
+    """
+    def __init__(self):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.requests.append((self.path, body))
+                data = json.dumps([{'translations': [{'text': item['Text'].upper()}]}
+                                   for item in body]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubSMTPServer(object):
+    """
+    Local SMTP server speaking just enough of the protocol for smtplib,
+    recording the messages and the connections it receives
+    """
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                stub.connections += 1
+                self.reply('220 stub')
+                data = None
+                for raw in self.rfile:
+                    line = raw.decode('utf-8').rstrip('\r\n')
+                    if data is not None:
+                        if line == '.':
+                            stub.messages.append('\n'.join(data))
+                            data = None
+                            self.reply('250 queued')
+                        else:
+                            data.append(line[1:] if line.startswith('..') else line)
+                    elif line[:4].upper() == 'DATA':
+                        data = []
+                        self.reply('354 end with .')
+                    elif line[:4].upper() == 'RCPT' and 'rejected' in line:
+                        self.reply('550 no such user')
+                    elif line[:4].upper() == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('250 ok')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_for(self, count, timeout=5):
+        """
+        Wait until `count` messages were received, mails being sent in the
+        background
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.messages
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
@@ -28,12 +202,93 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_default_iterations_need_no_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith(f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}$'))
+        self.assertFalse(u.password_needs_rehash())
+
+    def test_password_rehash_on_login(self):
+        self.app.config.update(WTF_CSRF_ENABLED=False, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertFalse(u.password_needs_rehash())
+
+        salt_length = self.app.config['PASSWORD_SALT_LENGTH']
+        self.app.config['PASSWORD_SALT_LENGTH'] = salt_length // 2
+        self.assertTrue(u.password_needs_rehash())
+        self.app.config['PASSWORD_SALT_LENGTH'] = salt_length
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertTrue(u.password_needs_rehash())
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'dog'})
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        db.session.refresh(u)
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hashing_rejects_when_busy(self):
+        self.app.config.update(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE=0)
+        started, release = threading.Event(), threading.Event()
+
+        def slow_hash(password, method, salt_length):
+            started.set()
+            release.wait(5)
+            return 'hash'
+
+        with mock.patch('app.passwords.generate_password_hash', slow_hash):
+            u = User(username='susan')
+
+            def set_password():
+                with self.app.app_context():
+                    u.set_password('cat')
+
+            worker = threading.Thread(target=set_password)
+            worker.start()
+            started.wait(5)
+            with self.assertRaises(HashingBusy) as busy:
+                User(username='john').set_password('dog')
+            self.assertEqual(busy.exception.code, 503)
+            release.set()
+            worker.join()
+        self.assertEqual(u.password_hash, 'hash')
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?s=128&d=identicon'))
 
+    def test_email_hash(self):
+        u = User(username='john', email='John@example.com')
+        self.assertEqual(u.email_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertEqual(u.email_hash, md5(b'susan@example.com').hexdigest())
+
+    def test_avatar_proxy(self):
+        self.app.config['AVATAR_PROXY'] = True
+        u = User(username='john', email='john@example.com')
+        with self.app.test_request_context():
+            url = u.avatar(128)
+        self.assertEqual(url, '/avatar/d4c74594d841139328695756648b6bd6/128')
+
+        gravatar = mock.Mock(status_code=200, content=b'png', headers={'Content-Type': 'image/png'})
+        client = self.app.test_client()
+        with mock.patch('app.avatars.http_session') as session:
+            session.return_value.get.return_value = gravatar
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'png')
+            self.assertIn('max-age', response.headers['Cache-Control'])
+
+            response = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(session.return_value.get.call_count, 1)
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -57,6 +312,29 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p = Post(body="post from susan", author=u2)
+        db.session.add_all([p, Post(body="another", author=u2)])
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.follower_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.follower_count, u2.post_count), (0, 1, 2))
+
+        db.session.delete(p)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count, u2.post_count), (0, 0, 1))
+
+        # reconciliation repairs counters that drifted
+        User.query.update({'follower_count': 7, 'post_count': 7})
+        db.session.commit()
+        User.reconcile_counters()
+        self.assertEqual((u1.follower_count, u2.post_count), (0, 1))
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -95,6 +373,1094 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.flush()
+        p1.fan_out()
+        db.session.commit()
+
+        # following backfills the followed user's existing posts
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.timeline().all(), [p1])
+
+        # new posts are pushed to the followers on write
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        p3 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p2, p3])
+        db.session.flush()
+        p2.fan_out()
+        p3.fan_out()
+        db.session.commit()
+        self.assertEqual(u1.timeline().all(), [p3, p2, p1])
+        self.assertEqual(u1.timeline().all(), u1.followed_posts().all())
+        self.assertEqual(u2.timeline().all(), [p1])
+
+        # unfollowing trims the timeline
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline().all(), [p3, p2])
+
+    def test_timeline_fanout_exempt(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        self.assertTrue(u3.is_fanout_exempt())
+
+        # mary has too many followers, so her posts are merged on read
+        p = Post(body="post from mary", author=u3, timestamp=datetime.utcnow())
+        db.session.add(p)
+        db.session.flush()
+        p.fan_out()
+        db.session.commit()
+        self.assertEqual(u1.followed_fanout_exempt_ids(), [u3.id])
+        self.assertEqual(u1.timeline().all(), [p])
+        self.assertEqual(u2.timeline().all(), [p])
+        self.assertEqual(u3.timeline().all(), [p])
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.utcnow()
+        # two posts share a timestamp to exercise the id tie breaker
+        posts = [Post(body=f"post {i}", author=u,
+                      timestamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            post.fan_out()
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        page1 = KeysetPagination(Post.query, 2)
+        self.assertEqual(page1.items, newest_first[:2])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+
+        page2 = KeysetPagination(Post.query, 2, after=decode_post_cursor(page1.next_cursor))
+        self.assertEqual(page2.items, newest_first[2:4])
+        self.assertTrue(page2.has_prev)
+
+        page3 = KeysetPagination(Post.query, 2, after=decode_post_cursor(page2.next_cursor))
+        self.assertEqual(page3.items, newest_first[4:])
+        self.assertFalse(page3.has_next)
+
+        back = KeysetPagination(Post.query, 2, before=decode_post_cursor(page3.prev_cursor))
+        self.assertEqual(back.items, page2.items)
+        self.assertTrue(back.has_prev)
+
+        # the timeline seeks on its own table and yields the same pages
+        timeline_page = u.timeline_page(2, after=decode_post_cursor(page1.next_cursor))
+        self.assertEqual(timeline_page.items, page2.items)
+
+    def test_last_seen_coalescing(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        seen = datetime(2022, 2, 5, 14, 9, 30)
+
+        # within the flush interval the time is only recorded in memory
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        last_seen.touch(u.id, seen)
+        db.session.expire_all()
+        self.assertNotEqual(u.last_seen, seen)
+        self.assertEqual(last_seen.get(u.id), seen)
+
+        last_seen.flush()
+        db.session.expire_all()
+        self.assertEqual(u.last_seen, seen)
+        self.assertIsNone(last_seen.get(u.id))
+
+        # once the interval has elapsed the pending times are written
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0
+        last_seen.touch(u.id, seen + timedelta(hours=1))
+        db.session.expire_all()
+        self.assertEqual(u.last_seen, seen + timedelta(hours=1))
+
+
+class SearchIndexingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.extensions['elasticsearch'] = FakeElasticsearch()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.app.extensions['elasticsearch'].bulk_requests.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_commit_sends_one_bulk_request(self):
+        p1 = Post(body="first", author=self.user)
+        p2 = Post(body="second", author=self.user)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(self.app.extensions['elasticsearch'].bulk_requests, [[
+            {'index': {'_index': 'post', '_id': p1.id}}, {'body': 'first'},
+            {'index': {'_index': 'post', '_id': p2.id}}, {'body': 'second'},
+        ]])
+
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(self.app.extensions['elasticsearch'].bulk_requests[-1],
+                         [{'delete': {'_index': 'post', '_id': p1.id}}])
+
+    def test_reindex_in_chunks(self):
+        db.session.add_all([Post(body=f"post {i}", author=self.user) for i in range(5)])
+        db.session.commit()
+        self.app.extensions['elasticsearch'].bulk_requests.clear()
+
+        Post.reindex(chunk_size=2)
+        self.assertEqual([len(body) // 2 for body in self.app.extensions['elasticsearch'].bulk_requests],
+                         [2, 2, 1])
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_queued_operations_are_drained_by_one_job(self):
+        self.app.redis = redis = fakeredis.FakeStrictRedis()
+        self.app.task_queue = mock.Mock()
+        db.session.add(Post(body="first", author=self.user))
+        db.session.commit()
+        db.session.add(Post(body="second", author=self.user))
+        db.session.commit()
+        self.assertEqual(self.app.task_queue.enqueue.call_count, 1)
+
+        # a flush holding the lock makes the other jobs wait, then retry
+        redis.set(pending_operations.lock_key, 'other')
+        with self.assertRaises(FlushBusy):
+            pending_operations.drain(lambda batch: None, 10, wait=0)
+        redis.delete(pending_operations.lock_key)
+
+        flush_pending_operations()
+        self.assertEqual(len(self.app.extensions['elasticsearch'].bulk_requests[-1]), 4)
+        self.assertEqual(redis.llen(pending_operations.key), 0)
+        self.assertIsNone(redis.get(pending_operations.scheduled_key))
+        self.assertIsNone(redis.get(pending_operations.lock_key))
+
+    def test_redis_outage_is_logged(self):
+        self.app.redis = Redis(port=1, socket_connect_timeout=0.1)
+        self.app.task_queue = mock.Mock()
+        post = Post(body="saved", author=self.user, id=1)
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            queue_index_operations([index_operation('post', post)])
+        self.app.task_queue.enqueue.assert_not_called()
+
+
+class LocalSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_commit_hooks_update_local_index(self):
+        p1 = Post(body="the quick brown fox", author=self.user)
+        p2 = Post(body="a lazy dog", author=self.user)
+        p3 = Post(body="the fox and the dog", author=self.user)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts.all()), {p1, p3})
+
+        p1.body = "a quick brown cat"
+        db.session.delete(p3)
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 0)
+
+        # the query syntax of the engine is never exposed to user input
+        posts, total = Post.search('cat" OR "dog', 1, 10)
+        self.assertEqual(total, 2)
+
+    def test_posts_flushed_before_commit_are_indexed(self):
+        post = Post(body="the quick brown fox", author=self.user)
+        db.session.add(post)
+        db.session.flush()
+        db.session.commit()
+
+        db.session.add(Post(body="a rolled back fox", author=self.user))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(Post.search_page('fox', 10).items, [post])
+
+    def test_search_pages(self):
+        posts = [Post(body=f"fox number {i}", author=self.user) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        page1 = Post.search_page('fox', 2)
+        page2 = Post.search_page('fox', 2, after=decode_cursor(page1.next_cursor))
+        page3 = Post.search_page('fox', 2, after=decode_cursor(page2.next_cursor))
+        found = page1.items + page2.items + page3.items
+        self.assertEqual(sorted(p.id for p in found), sorted(p.id for p in posts))
+        self.assertFalse(page3.has_next)
+
+        # reindex rebuilds the same results
+        get_local_search().clear('post')
+        self.assertEqual(Post.search('fox', 1, 10)[1], 0)
+        Post.reindex()
+        self.assertEqual(Post.search('fox', 1, 10)[1], 5)
+
+    def test_malformed_search_cursors(self):
+        db.session.add(Post(body="fox", author=self.user))
+        db.session.commit()
+        self.user.set_password('cat')
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': self.user.username, 'password': 'cat'})
+        for values in ([1], [1, 2, 3], ['x', 1], [0.5, 'abc'], [True, 1], {'a': 1}):
+            response = client.get('/search?q=fox&after=' + encode_cursor(values))
+            self.assertEqual(response.status_code, 400, values)
+        self.assertEqual(client.get('/search?q=fox&after=' + encode_cursor([-1.5, 3]))
+                         .status_code, 200)
+
+
+class TranslationCase(unittest.TestCase):
+    def setUp(self):
+        self.translator = StubTranslator()
+        self.app = create_app(TestConfig)
+        self.app.config.update(MS_TRANSLATOR_KEY='key', MS_TRANSLATOR_URL=self.translator.url,
+                               WTF_CSRF_ENABLED=False)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.translator.stop()
+
+    def test_translations_are_cached(self):
+        self.assertEqual(translate('sannu', 'ha', 'en'), 'SANNU')
+        self.assertEqual(translate('sannu', 'ha', 'en'), 'SANNU')
+        self.assertEqual(len(self.translator.requests), 1)
+
+        # only the texts missing from the cache are sent, in one call
+        self.assertEqual(translate_batch(['sannu', 'yaya', 'lafiya'], 'ha', 'en'),
+                         ['SANNU', 'YAYA', 'LAFIYA'])
+        self.assertEqual(len(self.translator.requests), 2)
+        self.assertEqual(self.translator.requests[-1][1],
+                         [{'Text': 'lafiya'}, {'Text': 'yaya'}])
+
+    def test_batch_endpoint(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+        response = client.post('/translate_batch', json={
+            'dest_language': 'en',
+            'items': [{'id': '1', 'text': 'sannu', 'source_language': 'ha'},
+                      {'id': '2', 'text': 'hallo', 'source_language': 'de'},
+                      {'id': '3', 'text': 'yaya', 'source_language': 'ha'}]})
+        self.assertEqual(response.get_json(), {'translations': {
+            '1': 'SANNU', '2': 'HALLO', '3': 'YAYA'}})
+        self.assertEqual(len(self.translator.requests), 2)
+
+        response = client.post('/translate_batch', json={'items': []})
+        self.assertEqual(response.status_code, 400)
+        for item in [{'id': [1], 'text': 'hello', 'source_language': 'en'},
+                     {'id': 1, 'text': 'hello', 'source_language': {'en': 1}},
+                     {'id': 1, 'text': ['hello'], 'source_language': 'en'}]:
+            response = client.post('/translate_batch', json={
+                'dest_language': 'es', 'items': [item]})
+            self.assertEqual(response.status_code, 400, item)
+
+
+class ResponseCacheCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add_all([self.user, Post(body="first post", author=self.user)])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_anonymous_pages_are_cached(self):
+        for url in ['/explore', '/user/john']:
+            first = self.client.get(url)
+            self.assertEqual(first.status_code, 200)
+            self.assertIsNotNone(first.headers.get('ETag'))
+            self.assertIsNotNone(first.headers.get('Last-Modified'))
+
+            # served from the cache: only the last modified lookup runs
+            with self.assertMaxQueries(1):
+                second = self.client.get(url)
+            self.assertEqual(second.data, first.data)
+
+            conditional = self.client.get(url, headers={'If-None-Match': first.headers['ETag']})
+            self.assertEqual(conditional.status_code, 304)
+
+    def test_new_post_invalidates(self):
+        etag = self.client.get('/user/john').headers['ETag']
+        db.session.add(Post(body="second post", author=self.user))
+        db.session.commit()
+
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('second post', response.get_data(as_text=True))
+        self.assertIn('second post', self.client.get('/explore').get_data(as_text=True))
+
+    def test_redis_outage_bypasses_the_cache(self):
+        self.app.redis = Redis(port=1, socket_connect_timeout=0.1)
+        response = self.client.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('ETag'))
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            invalidate('explore')
+
+    def test_listings_are_invalidated_on_commit(self):
+        version = tag_version('explore')
+        db.session.add(Post(body="rolled back", author=self.user))
+        db.session.flush()
+        # a page cached before the commit must not outlive it
+        self.assertEqual(tag_version('explore'), version)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(tag_version('explore'), version)
+
+        db.session.add(Post(body="second post", author=self.user))
+        db.session.flush()
+        self.assertEqual(tag_version('explore'), version)
+        db.session.commit()
+        self.assertEqual(tag_version('explore'), version + 1)
+
+
+class ListingQueriesCase(QueryCountMixin, unittest.TestCase):
+    # user loading, the page query and the count of page number
+    # pagination; never one query per post
+    MAX_QUERIES = 4
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                      for i in range(12)]
+        for user in self.users:
+            user.set_password('cat')
+        db.session.add_all(self.users)
+        db.session.commit()
+        reader = self.users[0]
+        for user in self.users[1:]:
+            reader.follow(user)
+        now = datetime.utcnow()
+        posts = [Post(body=f"post {i}", author=user,
+                      timestamp=now + timedelta(seconds=i))
+                 for i, user in enumerate(self.users)]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            post.fan_out()
+        db.session.commit()
+
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_fragment_cache(self):
+        self.client.get('/explore')
+        cache = self.app.extensions['post_fragment_cache'].local
+        self.assertEqual(len(cache), 10)
+        self.client.get('/explore')
+        self.assertEqual(len(cache), 10)
+
+        self.client.get('/user/user0')
+        self.assertEqual(len(cache), 11)
+
+        # renaming gives the author's posts new fragments
+        self.client.post('/edit_profile', data={'username': 'renamed', 'about_me': ''})
+        html = self.client.get('/user/renamed').get_data(as_text=True)
+        self.assertEqual(len(cache), 12)
+        self.assertNotIn('user0', html)
+
+        # so does an email change, for the new avatar
+        user = User.query.filter_by(username='renamed').one()
+        user.email = 'renamed@example.com'
+        db.session.commit()
+        html = self.client.get('/user/renamed').get_data(as_text=True)
+        self.assertEqual(len(cache), 13)
+        self.assertIn(user.email_hash, html)
+
+    def test_post_language_detected_after_commit(self):
+        self.client.post('/index', data={
+            'post': 'This is a fairly long English sentence about the weather today.'})
+        post = Post.query.order_by(Post.id.desc()).first()
+        self.assertEqual(post.language, 'en')
+
+    def test_backfill_languages(self):
+        text = 'Ceci est une phrase assez longue écrite en français pour le test.'
+        Post.query.update({'language': None, 'body': text})
+        db.session.commit()
+        self.assertEqual(backfill_languages(batch_size=5), 12)
+        self.assertEqual({p.language for p in Post.query}, {'fr'})
+        self.assertEqual(backfill_languages(), 0)
+
+    def test_listing_pages(self):
+        for url in ['/index', '/explore', '/user/user0', '/index?page=1',
+                    '/explore?page=2', '/search?q=post']:
+            with self.assertMaxQueries(self.MAX_QUERIES):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+
+        # the next page of the search results, through its cursor
+        html = self.client.get('/search?q=post').get_data(as_text=True)
+        self.assertEqual(html.count('<span id="post'), 10)
+        url = html_unescape(re.search(r'href="(/search\?[^"]*after=[^"]*)"', html).group(1))
+        with self.assertMaxQueries(self.MAX_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertEqual(response.get_data(as_text=True).count('<span id="post'), 2)
+
+
+class ApiCase(QueryCountMixin, unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                      for i in range(4)]
+        for user in self.users:
+            user.set_password('cat')
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.users[0].follow(self.users[1])
+        now = datetime.utcnow()
+        posts = [Post(body=f'post {i}', author=self.users[i % 2],
+                      timestamp=now + timedelta(seconds=i)) for i in range(15)]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            post.fan_out()
+        db.session.commit()
+
+        self.client = self.app.test_client()
+        credentials = base64.b64encode(b'user0:cat').decode()
+        response = self.client.post('/api/tokens',
+                                    headers={'Authorization': f'Basic {credentials}'})
+        self.headers = {'Authorization': f"Bearer {response.get_json()['token']}"}
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_token_required(self):
+        response = self.client.get('/api/users/1')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json(), {'error': 'Unauthorized'})
+        self.assertEqual(self.client.get('/api/users/99', headers=self.headers).get_json(),
+                         {'error': 'Not Found'})
+
+        self.client.delete('/api/tokens', headers=self.headers)
+        self.assertEqual(self.client.get('/api/users/1', headers=self.headers).status_code, 401)
+
+        # the pages outside of the api keep their html errors
+        response = self.client.get('/user/nobody', headers={'Accept': '*/*'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.mimetype, 'text/html')
+
+    def test_users_batch_and_fields(self):
+        with self.assertMaxQueries(3):
+            response = self.client.get('/api/users?ids=3,1,99&fields=username',
+                                       headers=self.headers)
+        self.assertEqual(response.get_json()['items'], [
+            {'id': 3, 'username': 'user2'}, {'id': 1, 'username': 'user0'}])
+        response = self.client.get('/api/users?ids=' + ','.join(['1'] * 101),
+                                   headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/users?ids=a', headers=self.headers).status_code,
+                         400)
+
+        self.assertEqual(self.client.get('/api/users/1', headers=self.headers)
+                         .get_json()['email'], 'user0@example.com')
+        self.assertNotIn('email', self.client.get('/api/users/2', headers=self.headers)
+                         .get_json())
+
+    def test_timeline_paging(self):
+        seen = []
+        url = '/api/timeline?per_page=5&fields=body'
+        while url:
+            with self.assertMaxQueries(4):
+                data = self.client.get(url, headers=self.headers).get_json()
+            seen.extend(post['body'] for post in data['items'])
+            url = data['_links']['next']
+        self.assertEqual(seen, [f'post {i}' for i in range(14, -1, -1)])
+
+    def test_follow_and_post(self):
+        response = self.client.post('/api/users/3/follow', headers=self.headers)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(User.query.get(3).follower_count, 1)
+        self.assertEqual(self.client.post('/api/users/1/follow', headers=self.headers)
+                         .status_code, 400)
+
+        response = self.client.post('/api/posts', json={'body': 'from the api'},
+                                    headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        post = self.client.get(response.headers['Location'], headers=self.headers).get_json()
+        self.assertEqual(post['author'], {'id': 1, 'username': 'user0'})
+        self.assertEqual(self.client.post('/api/posts', json={'body': 'x' * 151},
+                                          headers=self.headers).status_code, 400)
+
+        self.client.delete('/api/users/3/follow', headers=self.headers)
+        self.assertEqual(User.query.get(3).follower_count, 0)
+
+    def test_gzip(self):
+        response = self.client.get('/api/posts?per_page=15',
+                                   headers=dict(self.headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))['items']), 15)
+
+        response = self.client.get('/api/posts/1',
+                                   headers=dict(self.headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_per_page_is_clamped(self):
+        for value in ('0', '-5'):
+            data = self.client.get(f'/api/posts?per_page={value}', headers=self.headers).get_json()
+            self.assertEqual(len(data['items']), 1)
+        data = self.client.get('/api/timeline?per_page=0', headers=self.headers).get_json()
+        self.assertEqual(len(data['items']), 1)
+
+
+class DataTransferCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        register_commands(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        for user in users[1:]:
+            users[0].follow(user)
+        users[1].follow(users[2])
+        posts = [Post(body=f'post number {i}', author=users[i % 5], language='en')
+                 for i in range(23)]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            post.fan_out()
+        db.session.commit()
+        self.timelines = {user.id: [p.id for p in user.timeline()] for user in users}
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def round_trip(self, fmt):
+        runner = self.app.test_cli_runner()
+        path = os.path.join(self.dir, 'dump')
+        result = runner.invoke(args=['data', 'export', path, '--format', fmt,
+                                     '--chunk-size', '4'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Exported 33 rows', result.output)
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        result = runner.invoke(args=['data', 'import', path, '--chunk-size', '7'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported 5 user rows, 5 followers rows, 23 post rows', result.output)
+
+        user = User.query.filter_by(username='user0').one()
+        self.assertEqual((user.followed_count, user.post_count), (4, 5))
+        self.assertEqual(User.query.get(2).followed.all(), [User.query.get(3)])
+        for user_id, post_ids in self.timelines.items():
+            self.assertEqual([p.id for p in User.query.get(user_id).timeline()], post_ids)
+        self.assertEqual(Post.search('number', 1, 100)[1], 23)
+
+        # new rows get ids after the imported ones
+        post = Post(body='after the import', author=user)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(post.id, 24)
+
+    def test_ndjson_round_trip(self):
+        self.round_trip('ndjson')
+
+    def test_csv_round_trip(self):
+        self.round_trip('csv')
+        self.assertEqual(Post.query.get(1).language, 'en')
+        self.assertIsNone(User.query.get(1).about_me)
+
+
+class LiveUpdatesCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['LIVE_HEARTBEAT_SECONDS'] = 0.1
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+        for user in users:
+            user.set_password('cat')
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        db.session.commit()
+
+        self.clients = []
+        for user in users:
+            client = self.app.test_client()
+            client.post('/auth/login', data={'username': user.username, 'password': 'cat'})
+            self.clients.append(client)
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def events(self, response):
+        for chunk in response.response:
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if chunk.startswith('id:'):
+                yield json.loads(chunk.split('data: ', 1)[1])
+
+    def test_followers_receive_new_posts(self):
+        broker = self.app.extensions['live_updates']
+        reader = self.clients[0].get('/live', buffered=False)
+        self.assertEqual(reader.mimetype, 'text/event-stream')
+        self.assertEqual(broker.connections, 1)
+
+        self.clients[2].post('/index', data={'post': 'not followed'})
+        self.clients[1].post('/index', data={'post': 'hello followers'})
+        event = next(self.events(reader))
+        self.assertEqual(event['id'], Post.query.filter_by(body='hello followers').one().id)
+        self.assertIn('hello followers', event['html'])
+
+        reader.close()
+        self.assertEqual(broker.connections, 0)
+        self.assertEqual(broker.subscribers, {})
+
+    def test_connection_limit(self):
+        self.app.extensions['live_updates'].max_connections = 1
+        reader = self.clients[0].get('/live', buffered=False)
+        self.assertEqual(self.clients[1].get('/live', buffered=False).status_code, 503)
+        reader.close()
+
+    def test_redis_outage_does_not_fail_the_post(self):
+        broker = RedisBroker(Redis(port=1, socket_connect_timeout=0.1), 10, self.app.logger)
+        self.app.extensions['live_updates'] = broker
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            response = self.clients[1].post('/index', data={'post': 'hello followers'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Post.query.filter_by(body='hello followers').count(), 1)
+
+
+class StartupCase(unittest.TestCase):
+    # seconds for importing the app package and running create_app in a
+    # fresh interpreter, about a third of it is used today
+    BUDGET = 1.5
+
+    def test_cold_start(self):
+        # the default configuration, whatever the environment of the run
+        report = profile_startup(environ={})
+        self.assertEqual(report['lazy_modules_loaded'], [])
+        self.assertLess(report['import_app'] + report['create_app'], self.BUDGET)
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        primary = os.path.join(self.tmpdir.name, 'primary.db')
+        replica = os.path.join(self.tmpdir.name, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica]
+            RESPONSE_CACHE = False
+            WTF_CSRF_ENABLED = False
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replica = db.get_engine(self.app, bind='replica0')
+        db.Model.metadata.create_all(self.replica)
+
+        # the replica lags behind: it has the user but not their post
+        user = User(username='john', email='john@example.com')
+        user.set_password('cat')
+        db.session.add_all([user, Post(body='primary post', author=user)])
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), {
+                'id': user.id, 'username': 'john', 'email': 'john@example.com',
+                'password_hash': user.password_hash})
+        db.session.remove()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def test_reads_go_to_replica(self):
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertNotIn('primary post', html)
+
+    def test_reads_after_write_go_to_primary(self):
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.client.post('/index', data={'post': 'new post'})
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('primary post', html)
+        self.assertIn('new post', html)
+
+        # other clients keep reading from the replica; the session is
+        # removed by hand as the test app context outlives the requests
+        db.session.remove()
+        html = self.app.test_client().get('/explore').get_data(as_text=True)
+        self.assertNotIn('new post', html)
+
+    def test_api_reads_go_to_primary(self):
+        credentials = base64.b64encode(b'john:cat').decode()
+        token = self.client.post('/api/tokens', headers={
+            'Authorization': f'Basic {credentials}'}).get_json()['token']
+        client = self.app.test_client(use_cookies=False)
+        headers = {'Authorization': f'Bearer {token}'}
+        response = client.post('/api/posts', json={'body': 'api post'}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Set-Cookie', response.headers)
+
+        db.session.remove()
+        bodies = [post['body'] for post in client.get(
+            '/api/timeline', headers=headers).get_json()['items']]
+        self.assertEqual(bodies, ['api post'])
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        class MetricsConfig(TestConfig):
+            METRICS_ENABLED = True
+
+        self.app = create_app(MetricsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_pool_metrics(self):
+        client = self.app.test_client()
+        client.get('/explore')
+        metrics = client.get('/metrics/pool').get_json()['default']
+        self.assertGreater(metrics['checkouts'], 0)
+        self.assertGreater(metrics['connects'], 0)
+        self.assertGreaterEqual(metrics['wait_seconds_max'], 0)
+
+        # off by default
+        self.assertEqual(create_app(TestConfig).test_client().get(
+            '/metrics/pool').status_code, 404)
+
+    def test_pool_waits_are_timed_after_dispose(self):
+        stats = self.app.extensions['pool_metrics']['default']
+        waits = stats.waits
+        db.engine.dispose()
+        with mock.patch.object(PoolMetrics, 'WAIT_THRESHOLD', -1):
+            db.engine.connect().close()
+        self.assertEqual(stats.waits, waits + 1)
+
+    def test_prometheus_metrics(self):
+        client = self.app.test_client()
+        client.get('/explore')
+        client.get('/explore')
+        Post.search('anything', 1, 10)
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_http_request_duration_seconds_count'
+                      '{endpoint="main.explore",method="GET"} 2', text)
+        self.assertIn('microblog_http_requests_total'
+                      '{endpoint="main.explore",method="GET",status="200"} 2', text)
+        self.assertIn('microblog_db_queries_per_request_bucket'
+                      '{endpoint="main.explore",le="+Inf"} 2', text)
+        self.assertIn('microblog_external_call_duration_seconds_count'
+                      '{service="local",operation="query"} 1', text)
+        self.assertIn('microblog_db_pool_checkouts{bind="default"}', text)
+
+    def test_failed_requests_are_counted(self):
+        def fail():
+            raise RuntimeError('boom')
+        self.app.add_url_rule('/fail', 'fail', fail)
+        client = self.app.test_client()
+        with self.assertRaises(RuntimeError):
+            client.get('/fail')
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_http_requests_total'
+                      '{endpoint="fail",method="GET",status="500"} 1', text)
+
+
+class ProfilingCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        class ProfilingConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            SLOW_QUERY_THRESHOLD = 0
+            PROFILING_DIR = self.tmpdir.name
+
+        self.app = create_app(ProfilingConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        admin = User(username='admin', email=self.app.config['ADMINS'][0])
+        admin.set_password('cat')
+        db.session.add(admin)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def profiled_events(self, *args, **kwargs):
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get(*args, **kwargs)
+        return [record.fields for record in logs.records]
+
+    def test_profiling_header_is_for_admins(self):
+        with self.assertNoLogs(self.app.logger, 'WARNING'):
+            self.client.get('/explore', headers={'X-Profile': '1'})
+
+        self.client.post('/auth/login', data={'username': 'admin', 'password': 'cat'})
+        events = self.profiled_events('/explore', headers={'X-Profile': '1'})
+        request = events[-1]
+        self.assertEqual(request['event'], 'slow_request')
+        self.assertEqual(request['endpoint'], 'main.explore')
+        self.assertEqual(request['query_count'], len(request['queries']))
+        self.assertGreater(request['query_count'], 0)
+        self.assertGreater(request['template_time'], 0)
+        self.assertEqual([event['event'] for event in events[:-1]],
+                         ['slow_query'] * request['query_count'])
+
+    def test_sampled_requests_are_dumped(self):
+        self.app.config.update(PROFILING=True, PROFILING_SAMPLE_RATE=1)
+        self.profiled_events('/explore')
+        dumps = os.listdir(self.tmpdir.name)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].endswith('.prof'))
+
+    def test_profiler_stops_when_the_view_raises(self):
+        def fail():
+            raise RuntimeError('boom')
+        self.app.add_url_rule('/fail', 'fail', fail)
+        self.app.config.update(PROFILING=True, PROFILING_SAMPLE_RATE=1)
+        with self.assertRaises(RuntimeError):
+            self.client.get('/fail')
+        self.assertIsNone(sys.getprofile())
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 1)
+
+
+class MailCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = StubSMTPServer()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.port
+            MAIL_SUPPRESS_SEND = False
+            ERROR_MAIL_PER_MINUTE = 2
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.smtp.stop()
+
+    def test_emails_share_a_connection(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        with self.app.test_request_context():
+            for user in users:
+                send_reset_password_email(user)
+        self.assertEqual(len(self.smtp.wait_for(3)), 3)
+        self.assertTrue(any('To: user2@example.com' in m for m in self.smtp.messages))
+        self.assertEqual(self.smtp.connections, 1)
+
+    def test_error_mails_are_deduplicated_and_rate_limited(self):
+        handler = ErrorMailHandler(self.app, 'no-reply@example.com', ['admin@example.com'],
+                                   'Failure')
+        logger = logging.getLogger('tests.errors')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for _ in range(5):
+                logger.error('database is down')
+            self.assertEqual(len(self.smtp.wait_for(1)), 1)
+
+            logger.error('disk is full')
+            logger.error('out of memory')
+            self.assertEqual(len(self.smtp.wait_for(3, timeout=0.5)), 2)
+            self.assertIn('disk is full', self.smtp.messages[1])
+        finally:
+            logger.removeHandler(handler)
+
+    def test_sending_does_not_block_the_request(self):
+        self.smtp.stop()
+        with self.app.test_request_context():
+            with self.assertLogs(self.app.logger, 'ERROR'):
+                send_reset_password_email(User(username='john', email='john@example.com'))
+                # the mail thread sends in order, so this waits for the mail
+                _background_sender().executor.submit(lambda: None).result(5)
+
+    def test_full_mail_queue_drops_messages(self):
+        self.app.config['MAIL_QUEUE_SIZE'] = 1
+        sender = _background_sender()
+        release = threading.Event()
+        sender.executor.submit(release.wait)
+        message = {'subject': 'hi', 'sender': 'no-reply@example.com',
+                   'recipients': ['john@example.com'], 'html': None, 'body': 'hello'}
+        try:
+            queue_email([message])
+            with self.assertLogs(self.app.logger, 'WARNING'):
+                queue_email([message])
+        finally:
+            release.set()
+        self.assertEqual(len(self.smtp.wait_for(2, timeout=0.5)), 1)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_rejected_messages_do_not_block_the_queue(self):
+        self.app.redis = redis = fakeredis.FakeStrictRedis()
+        self.app.task_queue = mock.Mock()
+        message = {'subject': 'hi', 'sender': 'no-reply@example.com', 'html': None,
+                   'body': 'hello'}
+        send = [dict(message, recipients=['rejected@example.com']),
+                dict(message, recipients=['john@example.com'])]
+        queue_email(send)
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            flush_pending_email()
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertIn('To: john@example.com', self.smtp.messages[0])
+        self.assertEqual(redis.llen(pending_messages.key), 0)
+        self.assertEqual(json.loads(redis.lpop(FAILED_KEY)), send[0])
+
+
+class LoggingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_request_ids(self):
+        client = self.app.test_client()
+        first = client.get('/explore').headers['X-Request-ID']
+        self.assertNotEqual(client.get('/explore').headers['X-Request-ID'], first)
+        response = client.get('/explore', headers={'X-Request-ID': 'abc'})
+        self.assertEqual(response.headers['X-Request-ID'], 'abc')
+
+    def test_start_replaces_the_previous_queue(self):
+        create_app(TestConfig)
+        queues = [handler for handler in self.app.logger.handlers
+                  if isinstance(handler, QueueHandler)]
+        self.assertEqual(queues, [request_logging.queue_handler])
+        self.assertNotIn(default_handler, self.app.logger.handlers)
+
+    def test_json_records_are_written_by_a_background_thread(self):
+        self.app.config['ACCESS_LOG_SAMPLE_RATE'] = 1
+        records = []
+
+        class Capture(logging.Handler):
+            def emit(self, record):
+                records.append((threading.current_thread(), self.format(record)))
+
+        capture = Capture()
+        capture.setFormatter(JSONFormatter())
+        listener = request_logging.start(self.app, capture)
+        self.addCleanup(request_logging.stop)
+        self.assertNotIn(default_handler, self.app.logger.handlers)
+        self.app.test_client().get('/explore', headers={'X-Request-ID': 'abc'})
+        listener.queue.join()
+
+        thread, line = records[-1]
+        self.assertIsNot(thread, threading.current_thread())
+        access = json.loads(line)
+        self.assertEqual(access['logger'], 'app.access')
+        self.assertEqual(access['request_id'], 'abc')
+        self.assertEqual(access['path'], '/explore?')
+        self.assertEqual(access['status'], 200)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)